@@ -0,0 +1,296 @@
+# Stub of the Domoticz plugin module
+#
+# Lets plugin.py be imported and driven outside of Domoticz, by the benchmark in this folder. Only the parts of the
+# plugin API used by plugin.py are implemented:
+#
+#  - Log, Status, Error and Debug are collected in the lists below instead of being written to the Domoticz log
+#  - Device objects are kept in Devices, which the harness assigns to plugin.Devices, and count their updates
+#  - Connection supports the HTTP and WS protocols and raw TCP (Protocol "None") over real sockets. Callbacks are
+#    not called directly, they are queued like the Domoticz event loop does and delivered by Pump(). A raw
+#    connection reads what the peer answers right after every Send. A WS connection is upgraded by its first Send
+#    of an HTTP request; the frames the server pushes after that are read by Pump
+#
+# Set Domoticz.plugin to the imported plugin module before calling its onStart.
+#
+
+import base64
+import collections
+import http.client
+import os
+import select
+import socket
+import struct
+
+plugin = None
+debugging = 0
+heartbeat = 0
+messages = list()  # (level, text) of everything logged, if keepLog is set
+keepLog = False
+updates = 0  # Number of Device.Update calls
+creates = 0  # Number of Device.Create calls
+Devices = dict()
+events = collections.deque()  # Callbacks waiting to be delivered by Pump
+websockets = list()  # Upgraded WS connections, read by Pump
+WS_OPCODES = {0: "Continuation", 1: "Text", 2: "Binary", 8: "Close", 9: "Ping", 10: "Pong"}
+
+
+def _log(level, text):
+    if keepLog:
+        messages.append((level, text))
+
+
+def Log(text):
+    _log("Log", text)
+
+
+def Status(text):
+    _log("Status", text)
+
+
+def Error(text):
+    _log("Error", text)
+
+
+def Debug(text):
+    if debugging:
+        _log("Debug", text)
+
+
+def Debugging(level):
+    global debugging
+    debugging = level
+
+
+def Heartbeat(seconds):
+    global heartbeat
+    heartbeat = seconds
+
+
+def Pump(wait=0):
+    #
+    #   Deliver the queued callbacks to the plugin until none are left, returns the number delivered. The frames
+    #   waiting on the WS connections are queued first; with wait, up to that many seconds are waited for a frame
+    #   if none is there yet.
+    #
+    n = 0
+    while True:
+        sockets = [conn._sock for conn in websockets]
+        if sockets:
+            for sock in select.select(sockets, [], [], 0 if events or n else wait)[0]:
+                for conn in websockets:
+                    if conn._sock is sock:
+                        conn._receive()
+                        break
+        if not events:
+            return n
+        while events:
+            callback, args = events.popleft()
+            getattr(plugin, callback)(*args)
+            n += 1
+
+
+def Reset():
+    global updates
+    global creates
+    Devices.clear()
+    events.clear()
+    del websockets[:]
+    del messages[:]
+    updates = 0
+    creates = 0
+
+
+class Device:
+    def __init__(self, Name="", Unit=0, TypeName="", Type=0, Subtype=0, Switchtype=0, Image=0, Options=None,
+                 Used=0, DeviceID=""):
+        self.Name = Name
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Image = Image
+        self.Options = Options if Options is not None else {}
+        self.Used = Used
+        self.DeviceID = DeviceID
+        self.ID = 0
+        self.nValue = 0
+        self.sValue = ""
+        self.LastLevel = 0
+        self.TimedOut = 0
+
+    def __str__(self):
+        return "Unit: %d, Name: '%s', nValue: %d, sValue: '%s'" % (self.Unit, self.Name, self.nValue, self.sValue)
+
+    def Create(self):
+        global creates
+        if self.Unit in Devices:
+            Error("Device creation failed, Domoticz settings prevent accepting new devices")
+            return
+        self.ID = len(Devices) + 1
+        Devices[self.Unit] = self
+        creates += 1
+
+    def Update(self, nValue=0, sValue="", Options=None, TimedOut=0, **kwargs):
+        global updates
+        self.nValue = nValue
+        self.sValue = sValue
+        self.TimedOut = TimedOut
+        if Options is not None:
+            self.Options = Options
+        updates += 1
+
+    def Delete(self):
+        Devices.pop(self.Unit, None)
+
+
+class Connection:
+    def __init__(self, Name="", Transport="TCP/IP", Protocol="None", Address="127.0.0.1", Port="80", Baud=0):
+        self.Name = Name
+        self.Transport = Transport
+        self.Protocol = Protocol
+        self.Address = Address
+        self.Port = Port
+        self._http = None
+        self._sock = None
+        self._buffer = b""
+
+    def Connect(self):
+        if self.Protocol == "None" or self.Protocol == "WS":
+            try:
+                self._sock = socket.create_connection((self.Address, int(self.Port)), timeout=10)
+            except OSError as e:
+                events.append(("onConnect", (self, 1, str(e))))
+                return
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            events.append(("onConnect", (self, 0, "")))
+            return
+        if self.Protocol != "HTTP":
+            events.append(("onConnect", (self, 1, "Protocol " + self.Protocol + " not supported by the stub")))
+            return
+        self._http = http.client.HTTPConnection(self.Address, int(self.Port), timeout=10)
+        try:
+            self._http.connect()
+        except OSError as e:
+            self._http = None
+            events.append(("onConnect", (self, 1, str(e))))
+            return
+        events.append(("onConnect", (self, 0, "")))
+
+    def Connected(self):
+        return self._http is not None or self._sock is not None
+
+    def Connecting(self):
+        return False
+
+    def Disconnect(self):
+        if self._http is not None:
+            self._http.close()
+            self._http = None
+            events.append(("onDisconnect", (self,)))
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            self._buffer = b""
+            if self in websockets:
+                websockets.remove(self)
+            events.append(("onDisconnect", (self,)))
+
+    def Send(self, Message, Delay=0):
+        if self.Protocol == "WS":
+            if "Verb" in Message:
+                self._upgrade(Message)
+            else:
+                self._sock.sendall(self._frame(Message))
+            return
+        if self._sock is not None:
+            self._sock.sendall(Message)
+            #   Wait for the answer, then take whatever else has arrived
+            data = b""
+            timeout = 10
+            while select.select([self._sock], [], [], timeout)[0]:
+                chunk = self._sock.recv(65536)
+                if not chunk:
+                    self.Disconnect()
+                    break
+                data += chunk
+                timeout = 0
+            if data:
+                events.append(("onMessage", (self, data)))
+            return
+        body = Message.get("Data")
+        self._http.request(Message.get("Verb", "GET"), Message["URL"], body, Message.get("Headers", {}))
+        response = self._http.getresponse()
+        data = {"Status": str(response.status), "Data": response.read(), "Headers": dict(response.getheaders())}
+        events.append(("onMessage", (self, data)))
+
+    def _upgrade(self, Message):
+        # Send the HTTP upgrade request and deliver the response as the Status message Domoticz gives
+        headers = {"Upgrade": "websocket", "Connection": "Upgrade", "Sec-WebSocket-Version": "13",
+                   "Sec-WebSocket-Key": base64.b64encode(os.urandom(16)).decode('utf-8')}
+        headers.update(Message.get("Headers", {}))
+        request = "%s %s HTTP/1.1\r\n" % (Message.get("Verb", "GET"), Message["URL"])
+        request += "".join("%s: %s\r\n" % header for header in headers.items()) + "\r\n"
+        self._sock.sendall(request.encode('utf-8'))
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = self._sock.recv(4096)
+            if not chunk:
+                self.Disconnect()
+                return
+            data += chunk
+        head, sep, self._buffer = data.partition(b"\r\n\r\n")
+        lines = head.decode('latin-1').split("\r\n")
+        status = lines[0].split(" ")[1]
+        response = dict(line.split(": ", 1) for line in lines[1:] if ": " in line)
+        events.append(("onMessage", (self, {"Status": status, "Headers": response})))
+        if status == "101":
+            websockets.append(self)
+            self._frames()
+
+    def _frame(self, Message):
+        # Masked client frame of a message as the plugin sends it: Operation, Payload and Mask
+        opcode = dict((name, code) for code, name in WS_OPCODES.items())[Message.get("Operation", "Text")]
+        payload = Message.get("Payload", b"")
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        mask = struct.pack("<I", Message.get("Mask", 0) & 0xFFFFFFFF)
+        if len(payload) < 126:
+            header = struct.pack(">BB", 0x80 | opcode, 0x80 | len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack(">BBH", 0x80 | opcode, 0x80 | 126, len(payload))
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 0x80 | 127, len(payload))
+        return header + mask + bytes(b ^ mask[n % 4] for n, b in enumerate(payload))
+
+    def _receive(self):
+        # Read what the server has sent, called by Pump when the socket is readable
+        chunk = self._sock.recv(65536)
+        if not chunk:
+            self.Disconnect()
+            return
+        self._buffer += chunk
+        self._frames()
+
+    def _frames(self):
+        # Queue the complete frames in the buffer as onMessage calls, in the format Domoticz delivers them
+        while len(self._buffer) >= 2:
+            first, second = self._buffer[0], self._buffer[1]
+            length = second & 0x7F
+            pos = 2
+            if length == 126:
+                if len(self._buffer) < 4:
+                    return
+                length = struct.unpack_from(">H", self._buffer, 2)[0]
+                pos = 4
+            elif length == 127:
+                if len(self._buffer) < 10:
+                    return
+                length = struct.unpack_from(">Q", self._buffer, 2)[0]
+                pos = 10
+            if len(self._buffer) < pos + length:
+                return
+            payload = self._buffer[pos:pos + length]
+            self._buffer = self._buffer[pos + length:]
+            events.append(("onMessage", (self, {"Operation": WS_OPCODES.get(first & 0x0F, "Binary"),
+                                                "Finish": bool(first & 0x80), "Payload": payload})))
@@ -0,0 +1,143 @@
+# Benchmark of the plugin hot paths
+#
+# Runs plugin.py against the stub Domoticz module and the fake EVOK server in this folder, for a growing number of
+# devices, and reports per heartbeat cycle (onHeartbeat plus the callbacks it causes):
+#
+#  - wall time, median and max over the cycles
+#  - memory allocated by the cycle (tracemalloc peak and number of blocks still allocated after it)
+#  - number of Devices[...].Update calls
+#
+# and the time of a single devtounit, findSensor and UpdateDevice call. Every cycle polls all device classes. With
+# --modbus the inputs and relays are read from the fake Neuron Modbus TCP server instead of from the fake EVOK.
+#
+#   python3 benchmark/bench.py
+#   python3 benchmark/bench.py --sizes 8,32,128 --cycles 50 --change 0.05
+#   python3 benchmark/bench.py --modbus
+#
+
+import argparse
+import importlib
+import os
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(1, os.path.dirname(HERE))
+
+import Domoticz
+import fake_evok
+import fake_modbus
+
+MODEL = "Bench"
+MODBUS_STRIDE = 1000  # Registers per group of the fake Modbus server, room for the 99 circuits of a fake group
+
+
+def LoadPlugin(evok, port, size, home=None, modbus=None):
+    # Fresh plugin module, with a device map matching the fake EVOK, started against it. home is the plugin home
+    # folder, a new empty one by default. modbus is the port of a fake Modbus server, for Modbus mode
+    import plugin
+    plugin = importlib.reload(plugin)
+    Domoticz.Reset()
+    Domoticz.plugin = plugin
+    plugin.Devices = Domoticz.Devices
+    plugin.Parameters = {"Address": "127.0.0.1", "Port": str(port), "Mode1": "Normal", "Mode2": MODEL,
+                         "Mode3": "Modbus" if modbus else "Poll", "Mode4": "", "Mode5": "", "Mode6": "",
+                         "HomeFolder": (home or tempfile.mkdtemp(prefix="unipi-bench-")) + os.sep}
+    plugin.ADAPT_FAST_TIME = 0  # Every cycle polls all classes, no extra polls in between
+    if modbus:
+        plugin.MODBUS_PORT = str(modbus)
+        plugin.MODBUS_GROUP_REGISTERS = MODBUS_STRIDE
+    plugin.dType[MODEL] = {
+        "relays": dict((c, "/rest/relay/" + c) for c in (fake_evok.Circuit(n) for n in range(size))),
+        "inputs": dict((c, "/rest/input/" + c) for c in (fake_evok.Circuit(n) for n in range(size))),
+        "devices": {"1": "/rest/dev/1"},
+    }
+    plugin.onStart()
+    Domoticz.Pump()
+    return plugin
+
+
+def Cycle(plugin):
+    for ctl in plugin.controllers.values():
+        for cls in ctl["due"]:
+            ctl["due"][cls] = 0
+    plugin.onHeartbeat()
+    Domoticz.Pump()
+
+
+def Run(size, cycles, change, modbus=False):
+    evok = fake_evok.FakeEvok(inputs=size, relays=size, temps=max(1, size // 4), change=change)
+    server = fake_evok.Start(evok)
+    mbServer = fake_modbus.Start(fake_modbus.FakeModbus(evok, MODBUS_STRIDE)) if modbus else None
+    try:
+        plugin = LoadPlugin(evok, server.server_address[1], size, modbus=mbServer and mbServer.server_address[1])
+        Cycle(plugin)  # Discovery of the temp sensors
+
+        updates = Domoticz.updates
+        times = list()
+        for n in range(cycles):
+            start = time.perf_counter()
+            Cycle(plugin)
+            times.append(time.perf_counter() - start)
+        updates = (Domoticz.updates - updates) / cycles
+
+        tracemalloc.start()
+        peak = 0
+        blocks = 0
+        for n in range(max(1, cycles // 10)):
+            tracemalloc.reset_peak()
+            before = len(tracemalloc.take_snapshot().traces)
+            Cycle(plugin)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            blocks = max(blocks, len(tracemalloc.take_snapshot().traces) - before)
+        tracemalloc.stop()
+
+        circuit = fake_evok.Circuit(size - 1)
+        sensor = list(plugin.OneWireUnits)[-1] if plugin.OneWireUnits else ""
+        index = dict(((item["dev"], item["circuit"]), item) for item in evok.items)
+        unit = plugin.devtounit("inputs", circuit)
+        micro = {
+            "devtounit": min(timeit.repeat(lambda: plugin.devtounit("inputs", circuit), number=1000, repeat=3)),
+            "findSensor": min(timeit.repeat(lambda: plugin.findSensor(sensor, index), number=1000, repeat=3)),
+            "UpdateDevice": min(timeit.repeat(lambda: plugin.UpdateDevice(unit, 1, "x"), number=1000, repeat=3)),
+        }
+        plugin.onStop()
+        Domoticz.Pump()
+    finally:
+        server.shutdown()
+        server.server_close()
+        if mbServer is not None:
+            mbServer.shutdown()
+            mbServer.server_close()
+
+    return {"size": size, "devices": len(Domoticz.Devices), "median": statistics.median(times), "max": max(times),
+            "peak": peak, "blocks": blocks, "updates": updates, "micro": micro}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark plugin.py against a fake EVOK")
+    parser.add_argument("--sizes", default="4,16,64,128", help="comma separated numbers of inputs and of relays")
+    parser.add_argument("--cycles", type=int, default=30, help="heartbeat cycles per size")
+    parser.add_argument("--change", type=float, default=0.1, help="fraction of inputs and temps changing per poll")
+    parser.add_argument("--modbus", action="store_true", help="read the inputs and relays over Modbus TCP")
+    args = parser.parse_args()
+
+    print("%6s %8s %10s %10s %10s %8s %10s %12s %12s %14s" % (
+        "size", "devices", "median ms", "max ms", "peak KiB", "blocks", "updates", "devtounit us", "findSensor us",
+        "UpdateDevice us"))
+    for size in [int(size) for size in args.sizes.split(",")]:
+        r = Run(size, args.cycles, args.change, args.modbus)
+        print("%6d %8d %10.2f %10.2f %10.1f %8d %10.1f %12.3f %12.3f %14.3f" % (
+            r["size"], r["devices"], r["median"] * 1000, r["max"] * 1000, r["peak"] / 1024, r["blocks"],
+            r["updates"], r["micro"]["devtounit"] * 1000, r["micro"]["findSensor"] * 1000,
+            r["micro"]["UpdateDevice"] * 1000))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
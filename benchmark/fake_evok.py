@@ -0,0 +1,194 @@
+# Fake EVOK REST server
+#
+# Serves /rest/all, the per class endpoints /rest/<dev> and /rest/<dev>/<circuit> for a configurable number of
+# inputs, relays, 1-wire temp sensors and analog inputs and outputs, and accepts relay and analog output commands.
+# On every GET a fraction of the inputs toggle and of the temperatures drift, so the plugin has something to update.
+#
+# /ws is the EVOK WebSocket: every change, by a GET, a command or step(), is pushed to the connected clients as a
+# text frame with the list of changed items. publish() sends any text, for testing malformed frames.
+#
+# Run standalone for manual testing of the plugin in Domoticz:
+#   python3 fake_evok.py --port 8080 --inputs 24 --relays 16 --temps 8
+#
+
+import argparse
+import base64
+import hashlib
+import http.server
+import json
+import queue
+import random
+import struct
+import threading
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class FakeEvok:
+    def __init__(self, inputs=4, relays=4, temps=2, change=0.1, seed=1, analogs=1):
+        self.lock = threading.Lock()
+        self.change = change
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.subscribers = list()  # queue.Queue of the text frames for every WebSocket client
+        self.items = list()
+        for n in range(inputs):
+            self.items.append({"dev": "input", "circuit": Circuit(n), "value": 0, "counter": 0,
+                               "counter_mode": "Enabled", "debounce": 50, "glob_dev_id": 1})
+        for n in range(relays):
+            self.items.append({"dev": "relay", "circuit": Circuit(n), "value": 0, "pending": False,
+                               "relay_type": "physical", "glob_dev_id": 1})
+        for n in range(temps):
+            self.items.append({"dev": "temp", "circuit": "28%012X" % (0x5A0000 + n), "value": 21.0, "lost": False,
+                               "time": 0, "interval": 15, "typ": "DS18B20", "glob_dev_id": 1})
+        for n in range(analogs):
+            self.items.append({"dev": "ai", "circuit": Circuit(n), "value": 5.0, "unit": "V", "mode": "Voltage",
+                               "range": "10.0", "glob_dev_id": 1})
+            self.items.append({"dev": "ao", "circuit": Circuit(n), "value": 0.0, "unit": "V", "mode": "Voltage",
+                               "glob_dev_id": 1})
+        #   Items the plugin does not handle, as a real Neuron reports them
+        self.items.append({"dev": "neuron", "circuit": "1", "model": "FAKE", "sn": 1, "glob_dev_id": 1})
+        for n in range(4):
+            self.items.append({"dev": "led", "circuit": Circuit(n), "value": 0, "glob_dev_id": 1})
+        self.index = dict(((item["dev"], item["circuit"]), item) for item in self.items)
+
+    def step(self):
+        # Toggle a fraction of the inputs and let the temperatures drift, the changes are pushed on /ws
+        changed = list()
+        for item in self.items:
+            if self.random.random() >= self.change:
+                continue
+            if item["dev"] == "input":
+                item["value"] = 1 - item["value"]
+                item["counter"] += item["value"]
+            elif item["dev"] == "temp":
+                item["value"] = round(item["value"] + self.random.uniform(-0.5, 0.5), 2)
+            elif item["dev"] == "ai":
+                item["value"] = round(min(10.0, max(0.0, item["value"] + self.random.uniform(-0.2, 0.2))), 4)
+            else:
+                continue
+            changed.append(item)
+        if changed and self.subscribers:
+            self.publish(json.dumps(changed))
+
+    def publish(self, text):
+        # Push a text frame to every WebSocket client
+        for subscriber in list(self.subscribers):
+            subscriber.put(text)
+
+    def get(self, path):
+        parts = [part for part in path.split("/") if part]
+        with self.lock:
+            self.requests += 1
+            self.step()
+            if parts == ["rest", "all"]:
+                return self.items
+            if len(parts) == 2 and parts[0] == "rest":
+                items = [item for item in self.items if item["dev"] == parts[1]]
+                return items if items else None
+            if len(parts) == 3 and parts[0] == "rest":
+                return self.index.get((parts[1], parts[2]))
+        return None
+
+    def post(self, path, form):
+        parts = [part for part in path.split("/") if part]
+        with self.lock:
+            self.requests += 1
+            if len(parts) == 3 and parts[0] == "rest":
+                item = self.index.get((parts[1], parts[2]))
+                if item is not None and "value" in form:
+                    item["value"] = float(form["value"]) if parts[1] == "ao" else int(form["value"])
+                    self.publish(json.dumps([item]))
+                    return {"success": True, "result": item}
+        return None
+
+
+def Circuit(n):
+    # Neuron style circuit names, 1_01..1_99, 2_01..
+    return "%d_%02d" % (1 + n // 99, 1 + n % 99)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = 65536  # Headers and body in one segment, avoids delayed ACK stalls on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path == "/ws" and self.headers.get("Upgrade", "").lower() == "websocket":
+            self.websocket()
+            return
+        self.reply(self.server.evok.get(self.path))
+
+    def websocket(self):
+        # Upgrade to a WebSocket and push the frames published by the FakeEvok until the client goes away
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode('utf-8')).digest()).decode('utf-8')
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+        frames = queue.Queue()
+        self.server.evok.subscribers.append(frames)
+        try:
+            while True:
+                payload = frames.get().encode('utf-8')
+                if len(payload) < 126:
+                    header = struct.pack(">BB", 0x81, len(payload))
+                elif len(payload) < 65536:
+                    header = struct.pack(">BBH", 0x81, 126, len(payload))
+                else:
+                    header = struct.pack(">BBQ", 0x81, 127, len(payload))
+                self.wfile.write(header + payload)
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            self.server.evok.subscribers.remove(frames)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = dict(pair.split("=", 1) for pair in self.rfile.read(length).decode('utf-8').split("&") if "=" in pair)
+        self.reply(self.server.evok.post(self.path, form))
+
+    def reply(self, data):
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+def Start(evok, port=0):
+    # Serve evok on 127.0.0.1 from a background thread, returns the server. The port is server.server_address[1]
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.evok = evok
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake EVOK REST server")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--inputs", type=int, default=24)
+    parser.add_argument("--relays", type=int, default=16)
+    parser.add_argument("--temps", type=int, default=8)
+    parser.add_argument("--analogs", type=int, default=1, help="number of analog inputs and of analog outputs")
+    parser.add_argument("--change", type=float, default=0.1, help="fraction of inputs and temps changing per request")
+    args = parser.parse_args()
+    server = http.server.ThreadingHTTPServer(("0.0.0.0", args.port), Handler)
+    server.evok = FakeEvok(args.inputs, args.relays, args.temps, args.change, analogs=args.analogs)
+    print("Fake EVOK on port %d" % args.port)
+    server.serve_forever()
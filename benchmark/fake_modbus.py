@@ -0,0 +1,104 @@
+# Fake Neuron Modbus TCP server
+#
+# Serves the inputs and relays of a FakeEvok over Modbus TCP, with the register layout plugin.py expects of a Neuron:
+# per group g, starting at register (g - 1) * stride (100 on a Neuron), the bitmap of the inputs (one register per 16
+# inputs), the bitmap of the relays, and the 32 bit input counters, low word first. In group 1 the counters start at
+# register 8. Only the read holding registers function is implemented, others get an illegal function exception.
+# Every request steps the FakeEvok, as a REST request does. The 99 circuits per group of fake_evok.Circuit need a
+# stride of 1000, see MODBUS_GROUP_REGISTERS of the plugin.
+#
+# Run standalone for manual testing of the plugin in Domoticz, next to fake_evok.py:
+#   python3 fake_modbus.py --port 502 --inputs 24 --relays 16
+#
+
+import argparse
+import socket
+import socketserver
+import struct
+import threading
+
+import fake_evok
+
+
+class FakeModbus:
+    def __init__(self, evok, stride=100):
+        self.evok = evok
+        self.stride = stride
+        self.requests = 0
+
+    def registers(self):
+        # The register image of the current state of the FakeEvok, address -> value
+        groups = dict()
+        for item in self.evok.items:
+            if item["dev"] == "input" or item["dev"] == "relay":
+                group, n = item["circuit"].split("_")
+                groups.setdefault(int(group), {"input": dict(), "relay": dict()})[item["dev"]][int(n) - 1] = item
+        image = dict()
+        for group, items in groups.items():
+            base = (group - 1) * self.stride
+            inputs = max(items["input"], default=-1) + 1
+            relays = max(items["relay"], default=-1) + 1
+            do = base + (inputs + 15) // 16
+            counters = do + (relays + 15) // 16
+            if group == 1:
+                counters = max(8, counters)
+            for n, item in items["input"].items():
+                image[base + n // 16] = image.get(base + n // 16, 0) | item["value"] << n % 16
+                image[counters + 2 * n] = item["counter"] & 0xFFFF
+                image[counters + 2 * n + 1] = item["counter"] >> 16 & 0xFFFF
+            for n, item in items["relay"].items():
+                image[do + n // 16] = image.get(do + n // 16, 0) | item["value"] << n % 16
+        return image
+
+    def reply(self, tid, unit, pdu):
+        with self.evok.lock:
+            self.requests += 1
+            self.evok.step()
+            if pdu[0] != 3 or len(pdu) != 5:
+                answer = struct.pack(">BB", pdu[0] | 0x80, 1)
+            else:
+                start, count = struct.unpack(">HH", pdu[1:])
+                image = self.registers()
+                values = [image.get(address, 0) for address in range(start, start + count)]
+                answer = struct.pack(">BB%dH" % count, 3, 2 * count, *values)
+        return struct.pack(">HHHB", tid, 0, len(answer) + 1, unit) + answer
+
+
+class Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = self.request.makefile("rb")
+        while True:
+            header = stream.read(7)
+            if len(header) < 7:
+                return
+            tid, protocol, length, unit = struct.unpack(">HHHB", header)
+            pdu = stream.read(length - 1)
+            self.request.sendall(self.server.modbus.reply(tid, unit, pdu))
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def Start(modbus, port=0):
+    # Serve modbus on 127.0.0.1 from a background thread, returns the server. The port is server.server_address[1]
+    server = Server(("127.0.0.1", port), Handler)
+    server.modbus = modbus
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Neuron Modbus TCP server")
+    parser.add_argument("--port", type=int, default=502)
+    parser.add_argument("--inputs", type=int, default=24)
+    parser.add_argument("--relays", type=int, default=16)
+    parser.add_argument("--change", type=float, default=0.1, help="fraction of inputs changing per request")
+    parser.add_argument("--stride", type=int, default=100, help="registers per group")
+    args = parser.parse_args()
+    server = Server(("0.0.0.0", args.port), Handler)
+    server.modbus = FakeModbus(fake_evok.FakeEvok(args.inputs, args.relays, 0, args.change, analogs=0), args.stride)
+    print("Fake Neuron Modbus TCP server on port %d" % args.port)
+    server.serve_forever()
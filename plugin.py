@@ -51,12 +51,37 @@
     <param field="Mode2" label="Device Type" width="250px">
          <options>
             <option label="Unipi v1" value="Unipi"/>
+            <option label="Unipi 1.1" value="Unipi11"/>
             <option label="Neuron S103" value="S103"  default="true" />
+            <option label="Neuron M103" value="M103"/>
+            <option label="Neuron M203" value="M203"/>
+            <option label="Neuron M303" value="M303"/>
+            <option label="Neuron M403" value="M403"/>
+            <option label="Neuron M503" value="M503"/>
+            <option label="Neuron M523" value="M523"/>
+            <option label="Neuron L203" value="L203"/>
+            <option label="Neuron L303" value="L303"/>
+            <option label="Neuron L403" value="L403"/>
+            <option label="Neuron L503" value="L503"/>
+            <option label="Neuron L523" value="L523"/>
          </options>
     </param>
-    <param field="Mode1" label="Debug" width="75px">
+    <param field="Mode3" label="Update Mode" width="250px">
+         <options>
+            <option label="Poll (EVOK REST)" value="Poll"  default="true" />
+            <option label="Push (EVOK WebSocket)" value="Push"/>
+            <option label="Modbus TCP (Neuron)" value="Modbus"/>
+         </options>
+    </param>
+    <param field="Mode4" label="Poll Periods (s)" width="300px" default="input=2;relay=10;temp=60;discovery=180"/>
+    <param field="Mode5" label="Channel Settings" width="300px"/>
+    <param field="Mode6" label="Extra Controllers" width="300px"/>
+    <param field="Mode1" label="Debug" width="100px">
          <options>
             <option label="True" value="Debug"/>
+            <option label="Polling" value="Debug:poll"/>
+            <option label="Commands" value="Debug:command"/>
+            <option label="Discovery" value="Debug:discovery"/>
             <option label="False" value="Normal"  default="true" />
          </options>
       </param>
@@ -64,143 +89,604 @@
 </plugin>
 """
 
-import Domoticz, json
+import Domoticz, json, base64, os, queue, random, statistics, struct, threading, time
+import http.client
 
-from urllib.request import urlopen
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlencode
 
-heartbeatCount = 0
-HEARTBEAT_DIV = 20  # Every n:th call will trigger temp sensor detection
-OneWireIds = list()  # list of detected 1-wire sensors. First element in list maps to Unit[24] in  Domoticz.Device array
+POLL_TIMEOUT = 5  # Heartbeats to wait for a poll response before the EVOK connection is dropped
+POLL_PERIODS = {"input": 2, "relay": 10, "ai": 5, "ao": 60, "temp": 60, "discovery": 180}  # Default seconds, 0 = off
+POLL_URLS = {"input": "/rest/input", "relay": "/rest/relay", "ai": "/rest/ai", "ao": "/rest/ao", "temp": "/rest/temp",
+             "discovery": "/rest/all"}
+POLL_JITTER = 0.1  # Every period is varied randomly by this fraction, so the classes don't stay in lockstep
+POLL_BACKOFF_MAX = 8  # A failing class is polled at up to this multiple of its period
+pollPeriods = dict()  # class -> configured period in seconds, from POLL_PERIODS and the Poll Periods parameter
+PUSH_CHECK_PERIOD = 60  # In push mode, the classes are only polled this often as a consistency check
+ADAPT_CLASSES = ("input", "relay", "ai", "ao", "modbus")  # Classes polled faster on activity and slower when idle
+ADAPT_FAST_PERIOD = 0.25  # Seconds between the input polls of an active controller
+ADAPT_FAST_TIME = 5  # Seconds a controller stays active after an input change or a command, 0 = never fast
+ADAPT_IDLE_AFTER = 60  # Seconds without activity after which the periods of ADAPT_CLASSES start to grow
+ADAPT_IDLE_PERIOD = 30  # Longest period of an idle class, in seconds. Periods configured longer are kept
+BREAKER_THRESHOLD = 3  # Consecutive failed requests after which the circuit breaker of a controller opens
+BREAKER_BASE = 5  # Seconds the breaker stays open the first time, doubled every time the retry fails
+BREAKER_MAX = 60  # Longest time the breaker stays open, in seconds
+HEALTH_BASE_UNIT = 100  # First unit tried for the health devices of the controllers, after the temp sensors
+HEALTH_LEVELS = {"closed": (1, "Connected"), "half-open": (2, "Connecting"), "open": (4, "Unreachable")}  # Alert
+heartbeatPeriod = 10  # Seconds between heartbeats while no controller is active, set in onStart
+heartbeatFast = False  # True while the heartbeat is at 1 s for an active controller
+CONTROLLER_BASE_UNIT = 128  # First unit of the relays and inputs of the first extra controller
+CONTROLLER_PORT = "8080"  # Default EVOK port of an extra controller
+MAX_UNIT = 255  # Highest unit Domoticz accepts for a device of a plugin
+controllers = dict()  # name -> state of an EVOK endpoint, see NewController. The main controller is named ""
+connections = dict()  # Domoticz.Connection name -> (controller, True for the WebSocket)
+HTTP_POOL_SIZE = 4  # Max number of idle keep-alive connections kept per controller for the blocking EVOK requests
+HTTP_TIMEOUT = 3  # Seconds before a blocking EVOK request is abandoned
+httpLock = threading.Lock()  # Protects the connection pools, relay batches are sent from several threads
+RELAY_BATCH_WINDOW = 0.05  # Seconds relay commands are gathered before they are sent to EVOK together
+RELAY_BATCH_WORKERS = 4  # Number of relay commands of a batch sent concurrently
+relayExecutor = None  # ThreadPoolExecutor sending the relay batches, created in onStart
+IO_QUEUE_SIZE = 64  # Max number of work items waiting for the I/O thread, more are refused
+IO_LATENCY_WARN = 1.0  # Seconds from queueing to completion of a command above which EVOK is reported as slow
+
+MODBUS_PORT = "502"  # Port of the Neuron Modbus TCP server, on the address of the controller
+MODBUS_UNIT = 0  # Unit id of the Modbus requests
+MODBUS_CLASSES = ("input", "relay")  # Classes read over Modbus TCP in Modbus mode, the others stay on EVOK REST
+MODBUS_GROUP_REGISTERS = 100  # The registers of group g start at (g - 1) * MODBUS_GROUP_REGISTERS
+MODBUS_COUNTERS_1 = 8  # First input counter register of group 1, after its analog and status registers
+MODBUS_MAX_READ = 125  # Most registers a single read holding registers request may return
+ioQueue = queue.Queue(IO_QUEUE_SIZE)  # Work for the I/O thread: commands and cache writes, None stops the thread
+ioResults = deque()  # Results of the I/O thread, applied on the plugin thread by IoResults
+ioThread = None
+ioStats = {"queued": 0, "refused": 0, "sent": 0, "failed": 0, "depth": 0, "latency": 0.0}  # depth and latency: max
+ITEM_DEVS = ("input", "relay", "temp", "ai", "ao", "neuron")  # dev types handled, others are left out by ParseItems
+shadow = dict()  # unit -> [nValue, sValue, time.time() of the write] of the values last written to Domoticz
+REPUBLISH_INTERVAL = 300  # Seconds after which an unchanged temperature is written again, keeps last seen fresh
+WRITE_MIN_INTERVAL = 10  # Seconds a changed value with a deadband waits after the last write, calms chattering values
+TEMP_DEADBAND = 0.1  # Temperature changes smaller than this (deg C) are not written to Domoticz
+INVENTORY_FILE = "evok_inventory.json"  # Last known EVOK inventory, in the plugin home folder
+inventory = set()  # (dev, circuit) of the handled EVOK items, as found by the last discovery poll or the cache
+savedOneWireUnits = None  # OneWireUnits as last written to or read from the cache
+TEMP_BASE_UNIT = 24  # First unit used for 1-wire temp sensors
+OneWireUnits = dict()  # 1-wire sensor id -> unit of its Domoticz device, see BuildOneWireIndex
+ANALOG_BASE_UNIT = 21  # First unit tried for analog inputs and outputs
+ANALOG_WINDOW = 5  # Default number of samples an analog input is filtered over
+ANALOG_FILTER = "average"  # Default analog input filter, average or median
+ANALOG_FILTERS = ("average", "median")  # Analog input filters
+ANALOG_NUMBERS = ("gain", "offset", "window", "deadband")  # Analog channel settings that must be numbers
+ANALOG_DEADBAND = 0.01  # Default change of a filtered analog input value needed before it is written to Domoticz
+AO_RANGE = 10.0  # Analog output value at 100% of the Domoticz dimmer
+AnalogUnits = dict()  # (dev, circuit) -> unit of the Domoticz device of an analog input or output
+analogByUnit = dict()  # unit -> (dev, circuit), reverse of AnalogUnits
+analogChannels = dict()  # circuit -> sampling state of an analog input, see AnalogSample
+channelSettings = dict()  # (dev, circuit) -> {setting: value}, from the Channel Settings parameter
+METER_BASE_UNIT = 21  # First unit tried for meter devices
+METER_INTERVAL = 60  # Default seconds between two meter updates in Domoticz
+METER_TYPES = {"energy": "kWh", "water": "Waterflow", "pulse": "Custom"}  # meter setting -> Domoticz TypeName
+COUNTER_WRAP = 2 ** 32  # EVOK input counters are 32 bit
+EDGE_CAPTURE = True  # Report input pulses shorter than a poll period, detected by the EVOK counter of the input
+inputCounters = dict()  # input circuit -> counter of the input at the previous poll
+meters = dict()  # input circuit -> state of the meter fed by the counter of the input, see BuildMeters
+LOG_SUBSYSTEMS = ("poll", "command", "discovery")  # Parts of the plugin whose debug logging is set separately
+LOG_RATE_PERIOD = 60  # Seconds over which the info messages of a device are limited, see Info
+LOG_RATE_BURST = 5  # Info messages of a device logged per LOG_RATE_PERIOD, more are counted and suppressed
+logDebug = frozenset()  # Subsystems with debug logging on, from the Debug parameter
+logRate = dict()  # key -> [start of the current period, messages in it], see Info
+STATS_PHASES = ("fetch", "post", "parse", "dispatch", "update", "heartbeat", "command")  # Timed phases, see Timing
+STATS_BOUNDS = [0.00001 * 2 ** (n / 4) for n in range(90)]  # Bucket upper bounds in seconds, 10 us to 48 s
+STATS_FILE = "evok_timing.json"  # Timing statistics, in the plugin home folder
+STATS_BASE_UNIT = 100  # First unit tried for the timing sensors, after the temp sensors
+statsPeriod = 0  # Seconds between publications of the timing statistics, 0 = off. stats in the Poll Periods parameter
+statsDue = 0  # time.time() of the next publication
+statsHist = dict()  # phase -> array of the number of durations per bucket of STATS_BOUNDS
+statsSum = dict()  # phase -> total of the durations in seconds
+statsBusy = {"update": 0.0}  # Running total of the seconds spent in Devices[...].Update
+statsCounts = {"written": 0, "skipped": 0}  # Device updates written to Domoticz and skipped as unchanged
+statsUnits = dict()  # phase -> unit of the Custom sensor showing its p95
 
 device = "Unipi"
-dType = dict()
-dType["Unipi"] = {}
-dType["Unipi"]["relays"] = {
-    "1": "/rest/relay/1", "2": "/rest/relay/2", "3": "/rest/relay/3", "4": "/rest/relay/4", "5": "/rest/relay/5",
-    "6": "/rest/relay/6", "7": "/rest/relay/7", "8": "/rest/relay/8"
-}
-dType["Unipi"]["inputs"] = {
-    "1": "/rest/input/1", "2": "/rest/input/2", "3": "/rest/input/3", "4": "/rest/input/4", "5": "/rest/input/5",
-    "6": "/rest/input/6", "7": "/rest/input/7", "8": "/rest/input/8"
+#
+#   Relays and inputs of every model, as (type, group, count) descriptors: count circuits named group_01.. in EVOK,
+#   or 1.. for group 0. The digital outputs of a Neuron are relays in EVOK. Analog channels and 1-wire sensors are
+#   found by the discovery poll, and so are circuits missing here, of extension modules for example, see ExtendMap.
+#
+NEURON_DO = (("relays", 1, 4), ("inputs", 1, 4))  # Section 1 of every Neuron
+MODELS = {
+    "Unipi": (("relays", 0, 8), ("inputs", 0, 8), ("devices", 0, 2)),
+    "Unipi11": (("relays", 0, 8), ("inputs", 0, 14), ("devices", 0, 2)),
+    "S103": NEURON_DO + (("devices", 0, 2),),
+    "M103": NEURON_DO + (("relays", 2, 8), ("inputs", 2, 6), ("devices", 0, 2)),
+    "M203": NEURON_DO + (("relays", 2, 14), ("inputs", 2, 16), ("devices", 0, 2)),
+    "M303": NEURON_DO + (("inputs", 2, 30), ("devices", 0, 2)),
+    "M403": NEURON_DO + (("inputs", 2, 24), ("devices", 0, 2)),
+    "M503": NEURON_DO + (("relays", 2, 5), ("inputs", 2, 6), ("devices", 0, 2)),
+    "M523": NEURON_DO + (("relays", 2, 5), ("inputs", 2, 6), ("devices", 0, 2)),
+    "L203": NEURON_DO + (("relays", 2, 14), ("inputs", 2, 16), ("relays", 3, 14), ("inputs", 3, 16), ("devices", 0, 2)),
+    "L303": NEURON_DO + (("inputs", 2, 30), ("inputs", 3, 30), ("devices", 0, 2)),
+    "L403": NEURON_DO + (("inputs", 2, 24), ("inputs", 3, 24), ("devices", 0, 2)),
+    "L503": NEURON_DO + (("relays", 2, 5), ("inputs", 2, 6), ("relays", 3, 5), ("inputs", 3, 6), ("devices", 0, 2)),
+    "L523": NEURON_DO + (("relays", 2, 5), ("inputs", 2, 6), ("relays", 3, 5), ("inputs", 3, 6), ("devices", 0, 2)),
 }
-dType["Unipi"]["devices"] = {"1": "/rest/dev/1", "2": "/rest/dev/2", }
+TYPE_DEVS = {"relays": "relay", "inputs": "input", "devices": "dev"}  # dType type -> EVOK dev
+
+
+def ModelMap(descriptors):
+    # dType entry of a model, type -> {circuit: REST path}, generated from its MODELS descriptors
+    model = {"relays": dict(), "inputs": dict(), "devices": dict()}
+    for type, group, count in descriptors:
+        for n in range(1, count + 1):
+            circuit = "%d_%02d" % (group, n) if group else str(n)
+            model[type][circuit] = "/rest/" + TYPE_DEVS[type] + "/" + circuit
+    return model
 
-dType["S103"] = {}
-dType["S103"]["relays"] = {
-    "1_01": "/rest/relay/1_01", "1_02": "/rest/relay/1_02", "1_03": "/rest/relay/1_03", "1_04": "/rest/relay/1_04"
-}
-dType["S103"]["inputs"] = {
-    "1_01": "/rest/input/1_01", "1_02": "/rest/input/1_02", "1_03": "/rest/input/1_03", "1_04": "/rest/input/1_04"
-}
-dType["S103"]["devices"] = {"1": "/rest/dev/1", "2": "/rest/dev/2", }
+
+dType = dict((model, ModelMap(descriptors)) for model, descriptors in MODELS.items())
+
+
+unitIndex = dict()  # unit -> (type, circuit), built from the maps of the controllers by BuildUnitIndex
+circuitIndex = dict()  # (type, circuit) -> unit, reverse of unitIndex
+relayUrls = dict()  # relay circuit -> (controller, REST path), built by BuildUnitIndex
+DEV_TYPES = {"relay": "relays", "input": "inputs", "dev": "devices"}  # EVOK dev -> dType type
+
+
+def BuildUnitIndex(cached=None):
+    #
+    #   Number the circuits of the map of every controller: relays first, then inputs, then devices, each
+    #   group in sorted circuit order starting at the base unit of the controller, Unit 1 for the main controller.
+    #   The circuits of an extra controller are prefixed with its name, see ControllerOf. A circuit that already has
+    #   a Domoticz device, found by the dev and circuit stored in the Options of the device, keeps the unit of that
+    #   device, so units never shift once created. For devices without these Options the unit -> [type, circuit] map
+    #   of the inventory cache is used. A new circuit never takes a unit used by another device, see ClaimedUnits;
+    #   it takes the next free unit instead, and gets no unit at all if none is free up to MAX_UNIT. Devices without
+    #   dev and circuit in their Options, from earlier versions of the plugin, are adopted at the unit the map gives
+    #   them, see Reconcile.
+    #   Must be called again whenever a controller or its map changes.
+    #
+    global unitIndex
+    global circuitIndex
+
+    persisted = dict()
+    for x in Devices:
+        dev, circuit = DeviceCircuit(x)
+        if dev in DEV_TYPES:
+            persisted[(DEV_TYPES[dev], circuit)] = x
+    if cached is not None:
+        for x, (type, circuit) in cached.items():
+            if int(x) in Devices and DeviceCircuit(int(x)) == (None, None):
+                persisted.setdefault((type, circuit), int(x))
+    claimed = ClaimedUnits()
+    claimed.update(persisted.values())
+
+    unitIndex = dict()
+    circuitIndex = dict()
+    relayUrls.clear()
+    free = 1
+    for ctl in controllers.values():
+        u = ctl["base"]
+        for type in ("relays", "inputs", "devices"):
+            for circuit, path in sorted(ctl["map"][type].items()):
+                circuit = ctl["prefix"] + circuit
+                if type == "relays":
+                    relayUrls[circuit] = (ctl, path)
+                unit = persisted.get((type, circuit))
+                if unit is None:
+                    unit = u
+                    if unit > MAX_UNIT or unit in claimed or unit in unitIndex or \
+                            (unit in Devices and DeviceCircuit(unit) != (None, None)):
+                        while free in claimed or free in unitIndex or free in Devices:
+                            free += 1
+                        unit = free
+                    if unit > MAX_UNIT:
+                        Domoticz.Error("No free unit for " + type[:-1] + " " + circuit)
+                        u += 1
+                        continue
+                unitIndex[unit] = (type, circuit)
+                circuitIndex[(type, circuit)] = unit
+                u += 1
+    return
+
+
+def DeviceCircuit(Unit):
+    # EVOK dev and circuit stored in the Options of a Domoticz device, (None, None) for devices without them
+    options = Devices[Unit].Options
+    if not isinstance(options, dict) or "circuit" not in options:
+        return None, None
+    return options.get("dev"), options["circuit"]
+
+
+def Reconcile():
+    #
+    #   Create the Domoticz devices missing for the relays and inputs of the device map. Existing devices are kept
+    #   with their state. Devices created by earlier versions of the plugin, without dev and circuit in their
+    #   Options, are adopted at the unit the device map gives them and get the Options added.
+    #
+    created = 0
+    for unit, (type, circuit) in sorted(unitIndex.items()):
+        if type == "devices":
+            continue
+        dev = "relay" if type == "relays" else "input"
+        options = {"dev": dev, "circuit": circuit}
+        if unit not in Devices:
+            Domoticz.Device(Name=dev.capitalize() + " " + circuit, Unit=unit, TypeName="Switch",
+                            Options=options).Create()
+            created += 1
+        elif DeviceCircuit(unit) == (None, None):
+            Debug("discovery", "Adopt unit %d as %s %s", unit, dev, circuit)
+            Devices[unit].Update(nValue=Devices[unit].nValue, sValue=Devices[unit].sValue, Options=options)
+    if created > 0:
+        Domoticz.Log(str(created) + " relay and input devices created")
+    return
+
+
+def Debug(subsystem, message, *args):
+    # Debug message of a subsystem of LOG_SUBSYSTEMS. Formatted with args only if debugging of the subsystem is on
+    if subsystem in logDebug:
+        Domoticz.Debug(message % args if args else message)
+    return
+
+
+def Info(key, message, *args):
+    #
+    #   Informational message about key, a unit or anything else that can chatter. At most LOG_RATE_BURST
+    #   messages per key are logged every LOG_RATE_PERIOD seconds, the number suppressed is logged with the first
+    #   message of the next period.
+    #
+    now = time.time()
+    entry = logRate.get(key)
+    if entry is None or now - entry[0] >= LOG_RATE_PERIOD:
+        if entry is not None and entry[1] > LOG_RATE_BURST:
+            Domoticz.Log("%d messages like the next one suppressed" % (entry[1] - LOG_RATE_BURST))
+        entry = [now, 0]
+        logRate[key] = entry
+    entry[1] += 1
+    if entry[1] <= LOG_RATE_BURST:
+        Domoticz.Log(message % args if args else message)
+    return
 
 
 def unittodev(u):
-    # Get device name for unit number. Unit u  is 1..x based, while array is 0...x
-    global dType
-    global device
-    u -= 1
-    lenr = len(dType[device]["relays"])
-    leni = len(dType[device]["inputs"])
-    lend = len(dType[device]["devices"])
-    if u < lenr:
-        return "relays", sorted(dType[device]["relays"].keys())[u]
-    if u < lenr + leni:
-        return "inputs", sorted(dType[device]["inputs"].keys())[u - lenr]
-    if u < lenr + leni + lend:
-        return "devices", sorted(dType[device]["devices"].keys())[u - lenr - leni]
+    # Get device type and circuit for unit number. Returns (None, None) for units not in the device map
+    return unitIndex.get(u, (None, None))
 
 
 def devtounit(type, circuit):
-    global dType
-    global device
+    # Get unit number for device type and circuit. Returns None for circuits not in the device map
+    return circuitIndex.get((type, circuit))
 
-    lenr = len(dType[device]["relays"])
-    leni = len(dType[device]["inputs"])
-    lend = len(dType[device]["devices"])
 
-    if type == "relays":
-        return 1 + sorted(dType[device][type].keys()).index(circuit)
-    if type == "inputs":
-        return 1 + lenr + sorted(dType[device][type].keys()).index(circuit)
-    if type == "devices":
-        return 1 + lenr + lend + sorted(dType[device][type].keys()).index(circuit)
+def ParseControllers(extra):
+    #
+    #   Set up controllers: the main controller from the Address, Port and Device Type parameters, and the extra
+    #   ones from the Extra Controllers parameter, as "name=address:port/model@unit;..." where only the address is
+    #   required. port defaults to CONTROLLER_PORT, model to the Device Type and name to the address. The relays and
+    #   inputs of the first extra controller are numbered from CONTROLLER_BASE_UNIT, those of the next ones right
+    #   after the ones before, unless a base unit is given with @. A controller whose units would go past MAX_UNIT
+    #   is ignored.
+    #
+    controllers.clear()
+    ctl = NewController("", Parameters["Address"], Parameters["Port"], device, 1)
+    base = CONTROLLER_BASE_UNIT
+    for entry in extra.split(";"):
+        if entry.strip() == "":
+            continue
+        name, sep, endpoint = entry.strip().rpartition("=")
+        endpoint, sep, unit = endpoint.partition("@")
+        endpoint, sep, model = endpoint.partition("/")
+        address, sep, port = endpoint.partition(":")
+        name = name.strip() or address.strip()
+        try:
+            if address.strip() == "":
+                raise ValueError("no address")
+            if model.strip() and model.strip() not in dType:
+                raise ValueError("unknown device type " + model.strip())
+            if name in controllers or "/" in name:
+                raise ValueError("name " + name + " is not unique")
+            first = int(unit) if unit.strip() else base
+            last = first - 1 + sum(len(circuits) for circuits in dType[model.strip() or device].values())
+            if first < 1 or last > MAX_UNIT:
+                raise ValueError("units %d..%d are not within 1..%d" % (first, last, MAX_UNIT))
+            ctl = NewController(name, address.strip(), port.strip() or CONTROLLER_PORT, model.strip() or device,
+                                first)
+        except ValueError as e:
+            Domoticz.Error("Ignored controller '" + entry + "': " + str(e))
+            continue
+        base = ctl["base"] + sum(len(ctl["map"][type]) for type in ("relays", "inputs", "devices"))
+    return
+
+
+def NewController(name, address, port, model, base):
+    #
+    #   Add the state of a controller to controllers. Every controller has its own connections, poll schedule and
+    #   connection pool, so the controllers are polled concurrently and a slow one does not hold up the others.
+    #
+    ctl = {"name": name, "prefix": name + "/" if name else "", "address": address, "port": port,
+           "url": address + ":" + port, "device": model, "base": base,
+           "map": dict((type, dict(circuits)) for type, circuits in dType[model].items()),  # Copy of dType[model]
+           "conn": None,  # Domoticz.Connection used for the non-blocking polling
+           "ws": None,  # Domoticz.Connection to the EVOK WebSocket, only used in push mode
+           "mb": None,  # Domoticz.Connection to the Modbus TCP server, only used in Modbus mode, see ModbusSetup
+           "mbLayout": list(),  # Register blocks read per Modbus poll, see ModbusLayout
+           "mbReads": list(),  # (block, offset, count) of every read request of a Modbus poll
+           "mbRaw": list(),  # bytearray of the raw registers per block, filled by the responses
+           "mbLast": list(),  # bytearray of the raw registers per block last applied, see ModbusApply
+           "mbWait": dict(),  # transaction id -> index in mbReads of the outstanding Modbus requests
+           "mbTid": 0,  # Last Modbus transaction id used
+           "mbBuffer": bytearray(),  # Received Modbus bytes not making a complete response yet
+           "mbPending": 0,  # Number of heartbeats the outstanding Modbus poll has been waiting, 0 if none
+           "mbSent": 0,  # time.perf_counter() when the outstanding Modbus poll was sent
+           "templates": dict(),  # (dev, circuit) -> last /rest/all item of the inputs and relays, see ModbusApply
+           "pending": 0,  # Number of heartbeats the outstanding poll request has been waiting, 0 if none
+           "sent": 0,  # time.perf_counter() when the outstanding poll request was sent
+           "cls": None,  # class of the outstanding request
+           "queue": list(),  # classes that are due, in the order they will be requested
+           "periods": dict(),  # class -> period in seconds, pollPeriods minus the classes EVOK has no endpoint for
+           "due": dict(),  # class -> time.time() when the class is to be polled next
+           "backoff": dict(),  # class -> current multiplier of the period, doubled on every failed poll
+           "pool": list(),  # Idle keep-alive http.client connections to EVOK
+           "active": time.time(),  # time.time() of the last input change or command, see Activity
+           "fastUntil": 0,  # time.time() until which the inputs are polled every ADAPT_FAST_PERIOD
+           "fast": None,  # Thread running FastPoll
+           "state": "closed",  # Circuit breaker, see Breaker: closed, open or half-open
+           "failures": 0,  # Consecutive failed requests
+           "opened": 0,  # Consecutive times the breaker opened without a successful request in between
+           "retryAt": 0,  # time.time() when an open breaker goes to half-open
+           "health": None}  # Unit of the Alert device showing the breaker state
+    controllers[name] = ctl
+    return ctl
+
+
+def SetModel(ctl, model):
+    # Use the map of another model for a controller. The circuits it had beyond its old model are kept
+    extra = [(TYPE_DEVS[type], ctl["prefix"] + circuit) for type in ctl["map"] for circuit in ctl["map"][type]
+             if circuit not in dType[ctl["device"]][type]]
+    ctl["device"] = model
+    ctl["map"] = dict((type, dict(circuits)) for type, circuits in dType[model].items())
+    ExtendMap(ctl, extra)
+    return
+
+
+def ExtendMap(ctl, items):
+    #
+    #   Add the relays and inputs of a controller among items, (dev, circuit) pairs as in the inventory, that are
+    #   not in its map yet. True if any were added.
+    #
+    added = False
+    for dev, circuit in items:
+        type = DEV_TYPES.get(dev)
+        if type != "relays" and type != "inputs":
+            continue
+        owner, name = ControllerOf(circuit)
+        if owner is ctl and name not in ctl["map"][type]:
+            ctl["map"][type][name] = "/rest/" + dev + "/" + name
+            added = True
+    return added
+
+
+def DetectModel(ctl, index):
+    #
+    #   Check the map of a controller against a /rest/all document: the model EVOK reports in its neuron item
+    #   replaces the configured one if it is known, and relays and inputs the map lacks are added. The unit map
+    #   and the Domoticz devices follow. Units of existing devices never change, see BuildUnitIndex.
+    #
+    changed = False
+    for (dev, circuit), item in index.items():
+        if dev == "neuron" and ControllerOf(circuit)[0] is ctl:
+            model = str(item.get("model", ""))
+            if model in dType and model != ctl["device"]:
+                Domoticz.Log("EVOK on URL " + ctl["url"] + " reports model " + model + ", used instead of " +
+                             ctl["device"])
+                SetModel(ctl, model)
+                changed = True
+    if ExtendMap(ctl, index):
+        Domoticz.Log("EVOK on URL " + ctl["url"] + " reports relays or inputs beyond model " + ctl["device"])
+        changed = True
+    if changed:
+        BuildUnitIndex()
+        Reconcile()
+    return changed
+
+
+def ControllerOf(circuit):
+    # Controller of a circuit, and the circuit name on that controller. None for a prefix that is no controller
+    name, sep, circuit = circuit.rpartition("/")
+    return controllers.get(name), circuit
 
 
 def onStart():
     #
-    # Create all static devices available on UniPi, i.e. 8 relay devices, 12 digital inputs, 2 analog input ports
-    # and 1 analog output port.
+    # Create the static devices of the model, its relays and digital inputs as Domoticz Switches, numbered from
+    # Unit 1: relays first, then inputs, then the devices of MODELS, see BuildUnitIndex. A Unipi has relays 1..8
+    # and inputs 9..16, a Unipi 1.1 inputs 9..22; a Neuron starts with the 4 digital outputs and 4 inputs of its
+    # section 1. Extra controllers are numbered from CONTROLLER_BASE_UNIT.
     #
-    # Relays are defined as Domoticz Switches - Unit 1..8
-    # Digital Inputs as Domoticz  Switch Contact - Unit 9..20 - Not Implemented
-    # Analog Inputs as Domoticz Voltage - Unit 21,22 - Not implemented
-    # Analog Output as Domoticz Voltage - Unit 23 - Not implemented
+    # Only missing relay and input devices are created, see Reconcile, so a restart does not need EVOK at all.
     #
-    # 1-wire temp sensors are created dynamically when they are connected. They are detected in the onHeartbeat
-    # callback function
-    # Temp sensors - Unit 24..
+    # The other devices take the first free unit from their base unit, and keep it once created:
+    # Analog inputs as Domoticz Voltage (or Custom sensor for current inputs) and analog outputs as Domoticz Dimmer,
+    # created when found by the discovery poll - from Unit 21 (ANALOG_BASE_UNIT)
+    # Meters, see BuildMeters - from Unit 21 (METER_BASE_UNIT)
+    # 1-wire temp sensors, created when the discovery poll finds them - from Unit 24 (TEMP_BASE_UNIT)
+    # Health devices and timing sensors - from Unit 100 (HEALTH_BASE_UNIT, STATS_BASE_UNIT)
     #
-    global UNIPI_URL
     global device
     global dType
+    global inventory
+    global savedOneWireUnits
+    global relayExecutor
+    global ioThread
+    global heartbeatPeriod
+    global statsDue
+    global logDebug
 
-    UNIPI_URL = Parameters["Address"] + ":" + Parameters["Port"]
-    Domoticz.Log("Connect to UniPi EVOK API on URL %s" % UNIPI_URL)
-    if Parameters["Mode1"] == "Debug":
+    #   "Debug" turns on debug logging of every subsystem, "Debug:poll,command" of the ones listed
+    mode, sep, subsystems = Parameters["Mode1"].partition(":")
+    if mode == "Debug":
+        logDebug = frozenset(s.strip() for s in subsystems.split(",")) if sep else frozenset(LOG_SUBSYSTEMS)
         Domoticz.Debugging(1)
     device = Parameters["Mode2"]
-    ctr = 1
-    # expdevicecount = len((dType[device]["relays"]).keys()) + len((dType[device]["inputs"]).keys())
-    # if len(Devices) != expdevicecount:
-    #     for key in sorted(dType[device]["relays"]):
-    #         Domoticz.Device(Name="Relay " + key, Unit=ctr, TypeName="Switch").Create()
-    #         ctr += 1
-    #         Domoticz.Log("Relay " + key + " created!")
-    #     Domoticz.Log("Relay Devices created")
-    #     for key in sorted(dType[device]["inputs"]):
-    #         Domoticz.Device(Name="Input " + key, Unit=ctr, TypeName="Switch").Create()
-    #         ctr += 1
-    #         Domoticz.Log("Input " + key + " created!")
-    #     Domoticz.Log("Input Devices created")
-
-    #
-    #   pick up all previously detected 1-wire sensors
-    #
-    # if len(Devices) > expdevicecount:
-    response = urlopen("http://" + UNIPI_URL + "/rest/all").read().decode('utf-8')
-    data = json.loads(response)
-    for item in data:
-        Domoticz.Log("Add %s device %s" % (item["dev"], item["circuit"]))
-        if item["dev"] == 'input':
-            Domoticz.Device(Name="Input " + item["circuit"], Unit=ctr, TypeName="Switch", Options=item[
-                "circuit"]).Create()
-        elif item["dev"] == 'relay':
-            Domoticz.Device(Name="Relay " + item["circuit"], Unit=ctr, TypeName="Switch", Options=item["circuit"]).Create()
-        elif item["dev"] == "temp":
-            # OneWireIds.append(item["circuit"])
-            Domoticz.Device(Name="Temp Sensor " + item["circuit"], Unit=ctr, TypeName="Temperature",
-                            Options=item["circuit"]).Create()
-        ctr += 1
-
-    DumpConfigToLog()
-    Domoticz.Heartbeat(2)
+    ParseControllers(Parameters["Mode6"])
+    ParsePeriods(Parameters["Mode4"])
+    ResetStats()
+    for ctl in controllers.values():
+        Domoticz.Log("Connect to " + ctl["device"] + " EVOK API on URL " + ctl["url"])
+    #
+    #   Start from the inventory cached by the last run, so the temp sensors are updated from the first poll on
+    #   and nothing waits for EVOK. The cache is validated by the first discovery poll.
+    #
+    cache = LoadInventory()
+    if cache is not None:
+        inventory = set(tuple(item) for item in cache["inventory"])
+        for name, model in cache.get("models", {}).items():
+            if name in controllers and model in dType and model != controllers[name]["device"]:
+                SetModel(controllers[name], model)
+        for ctl in controllers.values():
+            ExtendMap(ctl, inventory)
+    BuildOneWireIndex(cache["onewire"] if cache is not None else None)
+    BuildAnalogIndex()
+    BuildUnitIndex(cache["units"] if cache is not None else None)
+    ParseChannels(Parameters["Mode5"])
+    BuildMeters()
+    BuildHealth()
+    BuildStats()
+    for ctl in controllers.values():
+        BreakerState(ctl, "half-open")  # Until the first request tells
+    if cache is not None:
+        savedOneWireUnits = dict(OneWireUnits)
+        Debug("discovery", "Inventory of %d items and %d 1-wire sensors loaded from cache", len(inventory),
+              len(OneWireUnits))
+    now = time.time()
+    for x in Devices:
+        shadow[x] = [Devices[x].nValue, Devices[x].sValue, now]
+    Reconcile()
+
+    if logDebug:
+        DumpConfigToLog()
+    relayExecutor = ThreadPoolExecutor(max_workers=RELAY_BATCH_WORKERS)
+    ioThread = threading.Thread(target=IoWorker, name="EVOK I/O", daemon=True)
+    ioThread.start()
+    now = time.time()
+    statsDue = now + statsPeriod
+    connections.clear()
+    for ctl in controllers.values():
+        suffix = " " + ctl["name"] if ctl["name"] else ""
+        ctl["conn"] = Domoticz.Connection(Name="EVOK" + suffix, Transport="TCP/IP", Protocol="HTTP",
+                                          Address=ctl["address"], Port=ctl["port"])
+        connections[ctl["conn"].Name] = (ctl, "rest")
+        if Parameters["Mode3"] == "Push":
+            ctl["ws"] = Domoticz.Connection(Name="EVOK WS" + suffix, Transport="TCP/IP", Protocol="WS",
+                                            Address=ctl["address"], Port=ctl["port"])
+            connections[ctl["ws"].Name] = (ctl, "ws")
+            ctl["ws"].Connect()
+        ctl["periods"].update(pollPeriods)
+        for cls in pollPeriods:
+            ctl["due"][cls] = now
+            ctl["backoff"][cls] = 1
+        if Parameters["Mode3"] == "Modbus":
+            ModbusSetup(ctl, suffix)
+        PollQueueDue(ctl)
+        ctl["conn"].Connect()
+    #   The heartbeat must be as fast as the fastest class, Domoticz accepts 1..30 seconds
+    heartbeatPeriod = min(30, max(1, int(min(pollPeriods.values()))))
+    Domoticz.Heartbeat(heartbeatPeriod)
     return True
 
 
 def onStop():
     Domoticz.Log("onStop called")
+    for ctl in controllers.values():
+        ctl["fastUntil"] = 0
+        if ctl["fast"] is not None:
+            ctl["fast"].join()
+    ioQueue.put(None)
+    ioThread.join()
+    IoResults()
+    Domoticz.Log("EVOK requests: %(queued)d queued, %(sent)d sent, %(failed)d failed, %(refused)d refused; "
+                 "max %(depth)d waiting, max latency %(latency).3f s" % ioStats)
+    if statsPeriod > 0:
+        WriteFile(Parameters["HomeFolder"] + STATS_FILE, StatsReport())
+    relayExecutor.shutdown(wait=True)
+    for ctl in controllers.values():
+        while ctl["pool"]:
+            ctl["pool"].pop().close()
     return True
 
 
-def onConnect(Status, Description):
-    Domoticz.Log("onConnect called")
+def onConnect(Connection, Status, Description):
+    ctl, kind = connections[Connection.Name]
+    if kind == "modbus":
+        if Status == 0:
+            Debug("poll", "Connected to Modbus TCP server on %s:%s", ctl["address"], MODBUS_PORT)
+            ModbusSend(ctl)
+        else:
+            Domoticz.Log("Failed to connect (" + str(Status) + ") to Modbus TCP server on " + ctl["address"] + ":" +
+                         MODBUS_PORT + ": " + Description)
+            PollSchedule(ctl, "modbus", False)
+            Breaker(ctl, False)
+        return True
+    if kind == "ws":
+        if Status == 0:
+            Debug("poll", "Connected to EVOK WebSocket on URL %s", ctl["url"])
+            Connection.Send({"Verb": "GET", "URL": "/ws",
+                             "Headers": {"Host": ctl["url"], "Origin": "http://" + ctl["url"],
+                                         "Sec-WebSocket-Key": base64.b64encode(os.urandom(16)).decode('utf-8')}})
+        else:
+            Domoticz.Log("Failed to connect (" + str(Status) + ") to EVOK WebSocket on URL " + ctl["url"] + ": " +
+                         Description)
+        return True
+
+    if Status == 0:
+        Debug("poll", "Connected to EVOK API on URL %s", ctl["url"])
+        PollNext(ctl)
+    else:
+        ctl["pending"] = 0
+        Domoticz.Log("Failed to connect (" + str(Status) + ") to EVOK API on URL " + ctl["url"] + ": " + Description)
+        while ctl["queue"]:
+            PollSchedule(ctl, ctl["queue"].pop(0), False)
+        Breaker(ctl, False)
     return True
 
 
-def onMessage(Data, Status, Extra):
-    Domoticz.Log("onMessage called")
+def onMessage(Connection, Data):
+    #
+    #   Response to the request sent by PollNext. The heartbeat only sends the request, the device updates are done
+    #   here when the response has arrived. The next due class of the controller, if any, is requested right away.
+    #
+    IoResults()
+    ctl, kind = connections[Connection.Name]
+    if kind == "ws":
+        WsMessage(ctl, Connection, Data)
+        return True
+    if kind == "modbus":
+        ModbusReceive(ctl, Data)
+        return True
+
+    Timing("fetch", time.perf_counter() - ctl["sent"])
+    cls = ctl["cls"]
+    ctl["cls"] = None
+    ctl["pending"] = 0
+    periods = ctl["periods"]
+    status = int(Data.get("Status", 0))
+    if status == 404 and cls != "discovery":
+        #   Older EVOK versions have no per class endpoints, and a board without analog channels has no /rest/ai.
+        #   The class is no longer polled on its own, the discovery reads it from /rest/all at its own period
+        Domoticz.Log(ctl["url"] + " has no " + POLL_URLS[cls] + " endpoint, " + cls + " is read from /rest/all")
+        del periods[cls]
+        if "discovery" not in periods:
+            periods["discovery"] = POLL_PERIODS["discovery"]
+            ctl["due"]["discovery"] = time.time()
+            ctl["backoff"]["discovery"] = 1
+    elif status != 200:
+        Domoticz.Error(ctl["url"] + " returned status " + str(status) + " for " + POLL_URLS[cls])
+        PollSchedule(ctl, cls, False)
+        Breaker(ctl, status < 500)
+    else:
+        PollSchedule(ctl, cls, True)
+        Breaker(ctl, True)
+        ProcessAll(ParseItems(Data["Data"]), cls == "discovery", ctl)
+    PollNext(ctl)
     return True
 
 
@@ -208,7 +694,9 @@ def onCommand(Unit, Command, Level, Hue):
     global device
     global dType
 
+    start = time.perf_counter()
     Domoticz.Log("onCommand called for Unit " + str(Unit) + ": Parameter '" + str(Command) + "', Level: " + str(Level))
+    IoResults()
 
     Command = Command.strip()
     #   action, sep, params = Command.partition(' ')
@@ -219,15 +707,32 @@ def onCommand(Unit, Command, Level, Hue):
     #
     type, name = unittodev(Unit)
 
+    if Unit in analogByUnit and analogByUnit[Unit][0] == "ao":
+        #
+        #   Analog outputs are dimmers, 0..100% is 0..AO_RANGE
+        #
+        circuit = analogByUnit[Unit][1]
+        if Command == 'Set Level':
+            level = Level
+        elif Command == 'On':
+            level = Devices[Unit].LastLevel if Devices[Unit].LastLevel > 0 else 100
+        elif Command == 'Off':
+            level = 0
+        else:
+            return True
+        if AnalogSet(circuit, level * AO_RANGE / 100):
+            UpdateDevice(Unit, 1 if level > 0 else 0, str(level))
+
     if type == "relays":
         if Command == 'On':
-            RelaySet(name, 1)
-            UpdateDevice(Unit, 1, 'On')
+            if RelaySet(name, 1):
+                UpdateDevice(Unit, 1, 'On')
 
         elif Command == 'Off':
-            RelaySet(name, 0)
-            UpdateDevice(Unit, 0, 'Off')
+            if RelaySet(name, 0):
+                UpdateDevice(Unit, 0, 'Off')
 
+    Timing("command", time.perf_counter() - start)
     return True
 
 
@@ -236,8 +741,26 @@ def onNotification(Data):
     return True
 
 
-def onDisconnect():
-    Domoticz.Log("onDisconnect called")
+def onDisconnect(Connection):
+    ctl, kind = connections[Connection.Name]
+    if kind == "ws":
+        Domoticz.Log("EVOK WebSocket on URL " + ctl["url"] + " closed")
+        return True
+    if kind == "modbus":
+        if ctl["mbPending"] > 0:
+            PollSchedule(ctl, "modbus", False)
+            Breaker(ctl, False)
+        ctl["mbPending"] = 0
+        ctl["mbWait"].clear()
+        del ctl["mbBuffer"][:]
+        Debug("poll", "Modbus connection to %s closed", ctl["address"])
+        return True
+    if ctl["cls"] is not None:
+        PollSchedule(ctl, ctl["cls"], False)
+        ctl["cls"] = None
+        Breaker(ctl, False)
+    ctl["pending"] = 0
+    Debug("poll", "EVOK connection to URL %s closed", ctl["url"])
     return True
 
 
@@ -245,41 +768,548 @@ def onHeartbeat():
     #
     #   Called periodically
     #
-    #   Every n:th call, the 1-wire bus will be scanned for new temp sensors and added
+    #   Every device class (input, relay, ai, ao, temp) is polled from its own EVOK endpoint at its own period,
+    #   see POLL_PERIODS and the Poll Periods parameter. The discovery class reads /rest/all to look for new temp
+    #   sensors. The heartbeat only queues the classes that are due and sends the first request, the responses are
+    #   handled in onMessage. If EVOK has not answered within POLL_TIMEOUT heartbeats the connection is dropped
+    #   and reopened on the next heartbeat.
+    #
+    #   In push mode the state changes arrive on the EVOK WebSocket, and while it is connected the classes are
+    #   polled at most every PUSH_CHECK_PERIOD seconds to catch anything the WebSocket might have missed.
+    #
+    #   Every controller has its own connections and schedule, their requests are outstanding at the same time.
+    #   In Modbus mode the inputs and relays are read from the Modbus TCP server instead, see ModbusSetup.
     #
-    #   For every call read all temp sensors and update accordingly
+    #   See Activity for the faster and slower polling of a controller that is active or idle, and Breaker for a
+    #   controller that does not respond.
+    #
+    global heartbeatFast
+
+    start = time.perf_counter()
+    IoResults()
+    now = time.time()
+    if heartbeatFast and all(ctl["fastUntil"] < now for ctl in controllers.values()):
+        heartbeatFast = False
+        Domoticz.Heartbeat(heartbeatPeriod)
+    for ctl in controllers.values():
+        if ctl["state"] == "open":
+            if now < ctl["retryAt"]:
+                continue
+            BreakerState(ctl, "half-open")
+        ws = ctl["ws"]
+        if ws is not None and not ws.Connected() and not ws.Connecting():
+            ws.Connect()
+        if ctl["mb"] is not None:
+            ModbusPoll(ctl, now)
+
+        conn = ctl["conn"]
+        PollQueueDue(ctl)
+        if conn.Connected():
+            if ctl["pending"] == 0:
+                PollNext(ctl)
+            elif ctl["pending"] >= POLL_TIMEOUT:
+                Domoticz.Error("No response from EVOK API on URL " + ctl["url"] + " within " + str(POLL_TIMEOUT) +
+                               " heartbeats, reconnecting")
+                ctl["pending"] = 0
+                conn.Disconnect()
+            else:
+                ctl["pending"] += 1
+        elif not conn.Connecting() and len(ctl["queue"]) > 0:
+            conn.Connect()
+
+    Timing("heartbeat", time.perf_counter() - start)
+    if statsPeriod > 0 and now >= statsDue:
+        PublishStats()
+    return True
+
+
+def WsMessage(ctl, Connection, Data):
     #
-    #   Read digital inputs - not implemented yet
-    #   Read analog inputs - not implemented yet
+    #   Frames from the EVOK WebSocket of a controller. Every text frame holds one changed device, or a list of
+    #   changed devices, in the same format as the items of /rest/all. A frame that is not valid JSON is logged and
+    #   ignored.
     #
-    global heartbeatCount
-    global OneWireIds
+    if "Status" in Data:
+        if int(Data["Status"]) == 101:
+            Domoticz.Log("Subscribed to EVOK WebSocket on URL %s" % ctl["url"])
+        else:
+            Domoticz.Error("EVOK WebSocket upgrade failed with status " + str(Data["Status"]))
+            Connection.Disconnect()
+        return
+
+    operation = Data.get("Operation", "")
+    if operation == "Ping":
+        Connection.Send({"Operation": "Pong", "Payload": Data.get("Payload", ""),
+                         "Mask": int.from_bytes(os.urandom(4), 'little')})
+    elif operation == "Close":
+        Connection.Disconnect()
+    elif "Payload" in Data:
+        payload = Data["Payload"]
+        try:
+            if isinstance(payload, (bytes, bytearray)):
+                payload = payload.decode('utf-8')
+            data = json.loads(payload)
+        except ValueError as e:
+            Domoticz.Error("Ignored malformed frame from EVOK WebSocket on URL " + ctl["url"] + ": " + str(e))
+            return
+        ProcessPush(data, ctl)
+    return
 
-    response = urlopen("http://" + UNIPI_URL + "/rest/all").read().decode('utf-8')
-    data = json.loads(response)
 
+def ProcessPush(data, ctl):
+    #
+    #   Apply the deltas pushed on the EVOK WebSocket of a controller. Items that are no device of ITEM_DEVS are
+    #   skipped, as ParseItems does, and items missing a field are logged and skipped
+    #
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        return
     for item in data:
-        if item["dev"] == "input":
-            circuit = item['circuit']
-            Domoticz.Debug("Circuit %s, value %s" % (item['circuit'], item["value"]))
-            value = int(item["value"])
-            d = {}
-            d["counter"] = int(item["counter"])
-            d["counter_mode"] = item["counter_mode"]
-            d["debounce"] = int(item["debounce"])
-            Unit = devtounit("inputs", circuit)
-            if value != Devices[Unit].nValue:
-                UpdateDevice(Unit, value,
-                             json.dumps(d))  # Devices[Unit].Update(nValue=value, sValue =   # json.dumps(d))
-
-    if heartbeatCount == 0:
-        Domoticz.Log("Scan for new temp sensors")
+        if not isinstance(item, dict) or item.get("dev") not in ITEM_DEVS or "circuit" not in item:
+            continue
+        item["circuit"] = ctl["prefix"] + item["circuit"]
+        try:
+            if item["dev"] == "temp":
+                checkAppend(item["circuit"])
+                if not item.get("lost", False):
+                    UpdateTemp(item["circuit"], item["value"])
+            else:
+                UpdateItem(item)
+        except (KeyError, TypeError, ValueError) as e:
+            Domoticz.Error("Ignored malformed " + item["dev"] + " " + item["circuit"] + " from EVOK WebSocket: " +
+                           repr(e))
+    return
+
+
+def ParsePeriods(periods):
+    #
+    #   Poll periods in seconds per class, as "input=2;relay=10;temp=60". Classes not mentioned keep their
+    #   default from POLL_PERIODS, 0 disables polling of a class. "stats" is the period of the timing statistics,
+    #   see PublishStats.
+    #
+    global statsPeriod
+
+    pollPeriods.clear()
+    pollPeriods.update(POLL_PERIODS)
+    statsPeriod = 0
+    for setting in periods.split(";"):
+        if setting.strip() == "":
+            continue
+        cls, sep, period = setting.partition("=")
+        cls = cls.strip()
+        try:
+            if cls == "stats":
+                statsPeriod = max(0.0, float(period))
+                continue
+            if cls not in POLL_PERIODS:
+                raise ValueError("unknown class")
+            pollPeriods[cls] = float(period)
+        except ValueError as e:
+            Domoticz.Error("Ignored poll period '" + setting + "': " + str(e))
+    for cls in [cls for cls in pollPeriods if pollPeriods[cls] <= 0]:
+        del pollPeriods[cls]
+    if len(pollPeriods) == 0:
+        pollPeriods["discovery"] = POLL_PERIODS["discovery"]
+    return
+
+
+def PollQueueDue(ctl):
+    now = time.time()
+    for cls in ctl["periods"]:
+        if now >= ctl["due"][cls] and cls in POLL_URLS and cls not in ctl["queue"] and cls != ctl["cls"]:
+            ctl["queue"].append(cls)
+    return
+
+
+def PollSchedule(ctl, cls, ok):
+    #
+    #   Set the next due time of a class of a controller after a poll. A failed poll doubles the period up to
+    #   POLL_BACKOFF_MAX times, a successful one restores it.
+    #
+    if ok:
+        ctl["backoff"][cls] = 1
+    else:
+        ctl["backoff"][cls] = min(POLL_BACKOFF_MAX, ctl["backoff"][cls] * 2)
+    period = ctl["periods"][cls] * ctl["backoff"][cls]
+    if ctl["ws"] is not None and ctl["ws"].Connected() and cls != "discovery":
+        period = max(period, PUSH_CHECK_PERIOD)
+    elif cls in ADAPT_CLASSES:
+        #   Stretch the period with the time the controller has been idle, up to ADAPT_IDLE_PERIOD. Inputs lose no
+        #   pulses by this, they are counted by EVOK, see MissedPulses
+        quiet = time.time() - ctl["active"]
+        period = max(period, min(ADAPT_IDLE_PERIOD, period * quiet / ADAPT_IDLE_AFTER))
+    ctl["due"][cls] = time.time() + period * (1 + random.uniform(-POLL_JITTER, POLL_JITTER))
+    return
+
+
+def Breaker(ctl, ok):
+    #
+    #   Circuit breaker of a controller, fed with the outcome of every request. After BREAKER_THRESHOLD
+    #   consecutive failures the breaker opens: the controller gets no requests at all, and commands for it are
+    #   refused at once, until its retry time. Then it is half-open, and the next request decides: a success closes
+    #   the breaker, a failure opens it again for twice as long, up to BREAKER_MAX seconds with jitter.
+    #
+    if ok:
+        if ctl["opened"] > 0:
+            Domoticz.Log("EVOK on URL " + ctl["url"] + " is back")
+        ctl["failures"] = 0
+        ctl["opened"] = 0
+        if ctl["state"] != "closed":
+            BreakerState(ctl, "closed")
+        return
+    ctl["failures"] += 1
+    if ctl["state"] == "half-open" or (ctl["state"] == "closed" and ctl["failures"] >= BREAKER_THRESHOLD):
+        delay = min(BREAKER_MAX, BREAKER_BASE * 2 ** ctl["opened"])
+        delay *= 1 + random.uniform(-POLL_JITTER, POLL_JITTER)
+        ctl["opened"] += 1
+        ctl["retryAt"] = time.time() + delay
+        Domoticz.Error("EVOK on URL " + ctl["url"] + " is not responding, next try in %d s" % delay)
+        BreakerState(ctl, "open")
+        for conn in (ctl["conn"], ctl["mb"]):
+            if conn is not None and (conn.Connected() or conn.Connecting()):
+                conn.Disconnect()
+    return
+
+
+def BreakerState(ctl, state):
+    # Set the breaker state of a controller and show it on its health device
+    ctl["state"] = state
+    if ctl["health"] is not None:
+        level, text = HEALTH_LEVELS[state]
+        UpdateDevice(ctl["health"], level, text)
+    return
+
+
+def Activity(ctl):
+    #
+    #   Called on an input change or a command of a controller. An idle controller gets its normal poll periods
+    #   back right away, and while the controller is active its inputs are polled every ADAPT_FAST_PERIOD by
+    #   FastPoll, and the heartbeat is 1 s so the results are applied soon. Not needed in push mode.
+    #
+    global heartbeatFast
+
+    now = time.time()
+    if now - ctl["active"] > ADAPT_IDLE_AFTER:
+        for cls in ADAPT_CLASSES:
+            if cls in ctl["periods"]:
+                ctl["due"][cls] = min(ctl["due"][cls], now + ctl["periods"][cls])
+    ctl["active"] = now
+    if ADAPT_FAST_TIME <= 0 or ctl["state"] != "closed" or "input" not in ctl["periods"] or \
+            (ctl["ws"] is not None and ctl["ws"].Connected()):
+        return
+    ctl["fastUntil"] = now + ADAPT_FAST_TIME
+    if ctl["fast"] is None or not ctl["fast"].is_alive():
+        ctl["fast"] = threading.Thread(target=FastPoll, args=(ctl,), name="EVOK fast poll", daemon=True)
+        ctl["fast"].start()
+    if not heartbeatFast and heartbeatPeriod > 1:
+        heartbeatFast = True
+        Domoticz.Heartbeat(1)
+    return
+
+
+def FastPoll(ctl):
+    #
+    #   Body of the fast poll thread of a controller: read the inputs every ADAPT_FAST_PERIOD until fastUntil, over
+    #   the connection pool. A response that differs from the one before is put in ioResults for IoResults. Stops
+    #   at the first failed request, the normal polling handles that.
+    #
+    last = None
+    while time.time() < ctl["fastUntil"]:
+        start = time.time()
+        try:
+            body = EvokRequest("GET", POLL_URLS["input"], None, ctl)
+        except Exception:
+            break
+        if body != last:
+            last = body
+            ioResults.append(("poll", ctl["name"], body))
+        time.sleep(max(0, ADAPT_FAST_PERIOD - (time.time() - start)))
+    return
+
+
+def PollNext(ctl):
+    if len(ctl["queue"]) == 0:
+        return
+    ctl["cls"] = ctl["queue"].pop(0)
+    ctl["pending"] = 1
+    ctl["sent"] = time.perf_counter()
+    ctl["conn"].Send({"Verb": "GET", "URL": POLL_URLS[ctl["cls"]],
+                      "Headers": {"Host": ctl["url"], "Accept": "application/json", "Connection": "keep-alive"}})
+    return
+
+
+def ModbusSetup(ctl, suffix):
+    #
+    #   Modbus mode: the classes of MODBUS_CLASSES of a controller are read directly from the Modbus TCP server of
+    #   the Neuron, in a few bulk requests per poll, instead of from EVOK. They are polled as the single class
+    #   "modbus" at the shortest of their periods. EVOK still serves the other classes, the discovery and the
+    #   commands. A model without a known register map stays on REST.
+    #
+    layout = ModbusLayout(ctl)
+    if layout is None:
+        Domoticz.Error("No Modbus register map for model " + ctl["device"] + " of EVOK on URL " + ctl["url"] +
+                       ", its inputs and relays are read from EVOK")
+        return
+    periods = [ctl["periods"].pop(cls) for cls in MODBUS_CLASSES if cls in ctl["periods"]]
+    if len(periods) == 0:
+        return
+    ctl["periods"]["modbus"] = min(periods)
+    ctl["due"]["modbus"] = time.time()
+    ctl["backoff"]["modbus"] = 1
+    ModbusReads(ctl, layout)
+    ctl["mb"] = Domoticz.Connection(Name="EVOK Modbus" + suffix, Transport="TCP/IP", Protocol="None",
+                                    Address=ctl["address"], Port=MODBUS_PORT)
+    connections[ctl["mb"].Name] = (ctl, "modbus")
+    ctl["mb"].Connect()
+    return
+
+
+def ModbusLayout(ctl):
+    #
+    #   Blocks of holding registers of a controller read per Modbus poll, one per group of the Neuron register map.
+    #   A group starts with the bitmap of its inputs, one register per 16 inputs, then the bitmap of its relays,
+    #   then the 32 bit counters of its inputs, low word first. In group 1 the counters come after the analog and
+    #   status registers. None if the map has circuits outside the groups, as the Unipi v1 has, or more than fit in
+    #   MODBUS_GROUP_REGISTERS.
+    #
+    groups = dict()
+    for type in ("inputs", "relays"):
+        for circuit in ctl["map"][type]:
+            group, sep, n = circuit.partition("_")
+            if not sep or not group.isdigit() or not n.isdigit() or int(group) == 0 or int(n) == 0:
+                return None
+            block = groups.setdefault(int(group), {"inputs": dict(), "relays": dict()})
+            block[type][int(n) - 1] = ctl["prefix"] + circuit
+    layout = list()
+    for group in sorted(groups):
+        block = groups[group]
+        inputs = max(block["inputs"], default=-1) + 1
+        relays = max(block["relays"], default=-1) + 1
+        block["start"] = (group - 1) * MODBUS_GROUP_REGISTERS
+        block["do"] = (inputs + 15) // 16
+        block["dc"] = block["do"] + (relays + 15) // 16  # End of the relay bitmap
+        block["counters"] = max(MODBUS_COUNTERS_1, block["dc"]) if group == 1 else block["dc"]
+        block["count"] = block["counters"] + 2 * inputs
+        if block["count"] > MODBUS_GROUP_REGISTERS:
+            return None
+        layout.append(block)
+    return layout
+
+
+def ModbusReads(ctl, layout):
+    #
+    #   Use a register layout for the Modbus polls of a controller, split into reads of up to MODBUS_MAX_READ. The
+    #   responses are copied into mbRaw, the raw registers of every block, and mbLast keeps the raw registers last
+    #   applied, None until a block has been applied in full
+    #
+    ctl["mbLayout"] = layout
+    ctl["mbReads"] = [(block, offset, min(MODBUS_MAX_READ, layout[block]["count"] - offset))
+                      for block in range(len(layout)) for offset in range(0, layout[block]["count"], MODBUS_MAX_READ)]
+    ctl["mbRaw"] = [bytearray(2 * block["count"]) for block in layout]
+    ctl["mbLast"] = [None] * len(layout)
+    return
+
+
+def ModbusPoll(ctl, now):
+    #
+    #   Heartbeat of the Modbus connection of a controller, as onHeartbeat does for the REST connection: connect or
+    #   poll when the modbus class is due, and reconnect if the server has not answered within POLL_TIMEOUT
+    #
+    mb = ctl["mb"]
+    if mb.Connected():
+        if ctl["mbPending"] == 0:
+            if now >= ctl["due"]["modbus"]:
+                ModbusSend(ctl)
+        elif ctl["mbPending"] >= POLL_TIMEOUT:
+            Domoticz.Error("No response from Modbus TCP server on " + ctl["address"] + ":" + MODBUS_PORT +
+                           " within " + str(POLL_TIMEOUT) + " heartbeats, reconnecting")
+            mb.Disconnect()
+        else:
+            ctl["mbPending"] += 1
+    elif not mb.Connecting() and now >= ctl["due"]["modbus"]:
+        mb.Connect()
+    return
+
+
+def ModbusSend(ctl):
+    #
+    #   Send all reads of a Modbus poll at once, with the read holding registers function. The transaction id of
+    #   a response tells which read it answers
+    #
+    ctl["mbWait"].clear()
+    for read, (block, offset, count) in enumerate(ctl["mbReads"]):
+        ctl["mbTid"] = (ctl["mbTid"] + 1) & 0xFFFF
+        ctl["mbWait"][ctl["mbTid"]] = read
+        ctl["mb"].Send(struct.pack(">HHHBBHH", ctl["mbTid"], 0, 6, MODBUS_UNIT, 3,
+                                   ctl["mbLayout"][block]["start"] + offset, count))
+    ctl["mbPending"] = 1
+    ctl["mbSent"] = time.perf_counter()
+    return
+
+
+def ModbusReceive(ctl, data):
+    #
+    #   Bytes received on the Modbus connection of a controller. TCP may split and join the responses, they are cut
+    #   from mbBuffer by the length in their MBAP header, and their registers are copied as they are, big endian,
+    #   into mbRaw. When every read of the poll is answered, the registers are applied by ModbusApply. An exception
+    #   response fails the poll, the server is reachable so the breaker is not fed with it.
+    #
+    buffer = ctl["mbBuffer"]
+    buffer += data
+    pos = 0
+    with memoryview(buffer) as view:
+        while len(buffer) - pos >= 6:
+            tid, protocol, length = struct.unpack_from(">HHH", buffer, pos)
+            if len(buffer) - pos < 6 + length:
+                break
+            frame = pos + 6  # Unit id, function, byte count, registers
+            pos = frame + length
+            read = ctl["mbWait"].pop(tid, None)
+            if read is None:
+                continue  # Answer to a poll given up on
+            block, offset, count = ctl["mbReads"][read]
+            if length != 3 + 2 * count or buffer[frame + 1] != 3 or buffer[frame + 2] != 2 * count:
+                Domoticz.Error("Modbus TCP server on " + ctl["address"] + " failed to read %d registers at %d: %s" % (
+                    count, ctl["mbLayout"][block]["start"] + offset,
+                    "exception %d" % buffer[frame + 2] if length == 3 and buffer[frame + 1] & 0x80 else
+                    "malformed response"))
+                ctl["mbWait"].clear()
+                ctl["mbPending"] = 0
+                PollSchedule(ctl, "modbus", False)
+                continue
+            ctl["mbRaw"][block][2 * offset:2 * (offset + count)] = view[frame + 3:pos]
+    del buffer[:pos]
+    if ctl["mbPending"] > 0 and len(ctl["mbWait"]) == 0:
+        Timing("fetch", time.perf_counter() - ctl["mbSent"])
+        ctl["mbPending"] = 0
+        PollSchedule(ctl, "modbus", True)
+        Breaker(ctl, True)
+        ModbusApply(ctl)
+    return
+
+
+def ModbusApply(ctl):
+    #
+    #   Update the devices from the registers of a Modbus poll. Only what changed is dispatched: a block equal to
+    #   the one last applied costs a single compare, otherwise the XOR of the two, as one integer, has a bit set
+    #   for every changed bit, and only the inputs and relays of those bits are turned into items. A block not
+    #   applied before is dispatched in full. The items are the ones the REST path produces, the fields Modbus does
+    #   not carry come from the same item of the last /rest/all; circuits not seen there yet wait for the
+    #   discovery. The metered inputs that are not dispatched are sampled all the same, a meter needs a sample
+    #   on every poll to write its rate when it stops counting.
+    #
+    start = time.perf_counter()
+    busy = statsBusy["update"]
+    for b, block in enumerate(ctl["mbLayout"]):
+        raw = ctl["mbRaw"][b]
+        last = ctl["mbLast"][b]
+        if last == raw:
+            ModbusMeters(block, raw, ())
+            continue
+        if last is None:
+            inputs = block["inputs"]
+            relays = block["relays"]
+            ctl["mbLast"][b] = bytearray(raw)
+        else:
+            inputs = set()
+            relays = set()
+            count = block["count"]
+            changed = int.from_bytes(raw, "big") ^ int.from_bytes(last, "big")
+            while changed:
+                bit = (changed & -changed).bit_length() - 1  # Lowest changed bit, register count - 1 - bit // 16
+                register = count - 1 - bit // 16
+                if register < block["do"]:
+                    inputs.add(16 * register + bit % 16)
+                elif register < block["dc"]:
+                    relays.add(16 * (register - block["do"]) + bit % 16)
+                elif register >= block["counters"]:
+                    inputs.add((register - block["counters"]) // 2)
+                changed &= ~(1 << bit) if register < block["dc"] else ~(0xFFFF << (bit - bit % 16))
+            last[:] = raw
+        ModbusDispatch(ctl, block, raw, inputs, relays)
+        ModbusMeters(block, raw, inputs)
+    Timing("dispatch", time.perf_counter() - start - (statsBusy["update"] - busy))
+    return
+
+
+def ModbusDispatch(ctl, block, raw, inputs, relays):
+    # Update the inputs and relays numbered in inputs and relays of a Modbus register block, from its raw registers
+    templates = ctl["templates"]
+    for n in inputs:
+        template = templates.get(("input", block["inputs"].get(n)))
+        if template is None:
+            continue
+        item = dict(template)
+        item["value"] = struct.unpack_from(">H", raw, 2 * (n // 16))[0] >> n % 16 & 1
+        low, high = struct.unpack_from(">HH", raw, 2 * (block["counters"] + 2 * n))
+        item["counter"] = low | high << 16
+        UpdateItem(item)
+    for n in relays:
+        template = templates.get(("relay", block["relays"].get(n)))
+        if template is None:
+            continue
+        item = dict(template)
+        item["value"] = struct.unpack_from(">H", raw, 2 * (block["do"] + n // 16))[0] >> n % 16 & 1
+        UpdateItem(item)
+    return
+
+
+def ModbusMeters(block, raw, inputs):
+    # Sample the meters of the inputs of a Modbus register block that are not in inputs, from its counter registers
+    for n, circuit in block["inputs"].items():
+        if circuit in meters and n not in inputs:
+            low, high = struct.unpack_from(">HH", raw, 2 * (block["counters"] + 2 * n))
+            MeterSample(circuit, low | high << 16)
+    return
+
+
+def ProcessAll(data, discover=False, ctl=None):
+    #
+    #   Process a /rest/all document, or the part of it returned by the endpoint of a single class, as the list of
+    #   items ParseItems returns. ctl is the controller the document comes from, the main controller by default;
+    #   the circuits of an extra controller get its prefix.
+    #
+    #   With discover set, the document will be scanned for new temp sensors and added
+    #
+    #   Read all temp sensors in the document and update accordingly
+    #
+    #   Read digital inputs, relays, analog inputs and outputs
+    #
+    #
+    #   Index the document on (dev, circuit) while updating inputs and relays, so every temp sensor below is
+    #   resolved with a single lookup instead of a scan of the whole document.
+    #
+    if ctl is None:
+        ctl = controllers[""]
+    start = time.perf_counter()
+    busy = statsBusy["update"]
+    prefix = ctl["prefix"]
+    index = dict()
+    for item in data:
+        if prefix:
+            item["circuit"] = prefix + item["circuit"]
+        index[(item["dev"], item["circuit"])] = item
+        UpdateItem(item)
+
+    if discover:
+        Debug("discovery", "Scan for new temp sensors")
         #
         #   For each found temp sensor, check if Domoticz device is defined for this sensor. If not, create the device.
         #
-        for item in data:
-            if item["dev"] == "temp":
-                checkAppend(item["circuit"])
+        for dev, circuit in index:
+            if dev == "temp":
+                checkAppend(circuit)
+            elif dev == "ai" or dev == "ao":
+                checkAnalog(dev, circuit, index[(dev, circuit)])
+        if DetectModel(ctl, index):
+            SaveInventory()
+            if ctl["mb"] is not None:
+                ModbusReads(ctl, ModbusLayout(ctl) or ctl["mbLayout"])
+        ValidateInventory(set(index), ctl)
+        if ctl["mb"] is not None:
+            ctl["templates"] = dict((key, item) for key, item in index.items() if key[0] in MODBUS_CLASSES)
+            ctl["mbLast"] = [None] * len(ctl["mbLayout"])  # Dispatch every circuit with its new template
 
     #
     #   Check all defined Domoticz temp devices. If any of those is not available, delete device the device if last
@@ -288,20 +1318,212 @@ def onHeartbeat():
     #
     #   ----- End of update of sensors
     #
-    #   Update Domoticz temp devices with current reading on every hearbeat
+    #   Update Domoticz temp devices with current reading
     #
-    if len(OneWireIds) > 0:
-        for n in range(0, len(OneWireIds)):
-            if findSensor(OneWireIds[n], data):
-                Domoticz.Debug("Update temp from 1-wire sensor #" + str(n + 1) + " " + OneWireIds[n])
-                Devices[24 + n].Update(nValue=int(findSensor(OneWireIds[n], data)),
-                                       sValue=str(findSensor(OneWireIds[n], data)))
+    for sensorId in OneWireUnits:
+        value = findSensor(sensorId, index)
+        if value is not None:
+            UpdateTemp(sensorId, value)
 
-    heartbeatCount = heartbeatCount + 1
-    if heartbeatCount == HEARTBEAT_DIV:
-        heartbeatCount = 0
+    Timing("dispatch", time.perf_counter() - start - (statsBusy["update"] - busy))
+    return
 
-    return True
+
+def LoadInventory():
+    #
+    #   The inventory cached by SaveInventory, None if there is no usable cache for the selected device type
+    #
+    try:
+        with open(Parameters["HomeFolder"] + INVENTORY_FILE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError) as e:
+        Debug("discovery", "No inventory cache: %s", e)
+        return None
+    if cache.get("device") != device:
+        Domoticz.Log("Inventory cache is for device type " + str(cache.get("device")) + ", ignored")
+        return None
+    return cache
+
+
+def SaveInventory():
+    #
+    #   Write the inventory, unit map and 1-wire sensors to the cache file, on the I/O thread so a slow SD card
+    #   does not hold up the plugin. Written directly if the I/O queue is full.
+    #
+    global savedOneWireUnits
+
+    savedOneWireUnits = dict(OneWireUnits)
+    cache = {"device": device,
+             "models": dict((ctl["name"], ctl["device"]) for ctl in controllers.values()),
+             "units": dict((str(u), list(unitIndex[u])) for u in unitIndex),
+             "onewire": dict(OneWireUnits),
+             "inventory": sorted(list(item) for item in inventory)}
+    path = Parameters["HomeFolder"] + INVENTORY_FILE
+    try:
+        ioQueue.put_nowait(("save", path, cache))
+    except queue.Full:
+        ioResults.append(("save", path, WriteFile(path, cache)))
+    return
+
+
+def WriteFile(path, data):
+    #
+    #   Write data as JSON to path, through a temporary file so a power cut never leaves a truncated file. Returns
+    #   the error, None if written.
+    #
+    try:
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        return e
+    return None
+
+
+def ValidateInventory(found, ctl):
+    #
+    #   Compare the items found by a discovery poll of a controller with its part of the cached inventory, and
+    #   rewrite the cache if they differ or the 1-wire sensors have changed.
+    #
+    global inventory
+
+    known = set(item for item in inventory if ControllerOf(item[1])[0] is ctl)
+    if found == known and savedOneWireUnits == OneWireUnits:
+        return
+    if len(known) == 0:
+        Domoticz.Log("Inventory of " + str(len(found)) + " EVOK items of URL " + ctl["url"] + " cached")
+    else:
+        for dev, circuit in sorted(found - known):
+            Domoticz.Log("EVOK reports new " + dev + " " + circuit)
+        for dev, circuit in sorted(known - found):
+            Domoticz.Log("EVOK no longer reports " + dev + " " + circuit)
+    inventory = (inventory - known) | found
+    SaveInventory()
+    return
+
+
+def UpdateItem(item):
+    #
+    #   Update the Domoticz device of a single input, relay, analog input or analog output item from EVOK
+    #
+    if item["dev"] == "input":
+        circuit = item['circuit']
+        counter = int(item["counter"])
+        if circuit in meters:
+            MeterSample(circuit, counter)
+        Unit = devtounit("inputs", circuit)
+        if Unit is None:
+            return
+        Debug("poll", "Circuit %s, value %s", item['circuit'], item["value"])
+        value = int(item["value"])
+        pulses = MissedPulses(circuit, Unit, value, counter, item["counter_mode"]) if EDGE_CAPTURE else 0
+        if pulses == 0 and not ShadowDue(Unit, value):
+            statsCounts["skipped"] += 1
+            return
+        if pulses > 0 or Unit not in shadow or shadow[Unit][0] != value:
+            Activity(ControllerOf(circuit)[0])
+        d = {}
+        d["counter"] = counter
+        d["counter_mode"] = item["counter_mode"]
+        d["debounce"] = int(item["debounce"])
+        sValue = json.dumps(d)
+        if pulses > 0:
+            #   Replay the missed pulse as a transition away from the previous level and back, so Domoticz sees the
+            #   event, before the current level is written
+            previous = shadow[Unit][0] if Unit in shadow else Devices[Unit].nValue
+            Info(Unit, "Input %s: %d pulse(s) between polls", circuit, pulses)
+            UpdateDevice(Unit, 1 - previous, sValue)
+            UpdateDevice(Unit, previous, sValue)
+        UpdateDevice(Unit, value, sValue)  # Devices[Unit].Update(nValue=value, sValue =   # json.dumps(d))
+    elif item["dev"] == "relay":
+        Unit = devtounit("relays", item['circuit'])
+        if Unit is None:
+            return
+        value = int(item["value"])
+        UpdateDevice(Unit, value, 'On' if value else 'Off')
+    elif item["dev"] == "ai":
+        Unit = AnalogUnits.get(("ai", item["circuit"]))
+        if Unit is None:
+            return
+        value = AnalogSample(item["circuit"], float(item["value"]))
+        UpdateDevice(Unit, 0, "%.3f" % value, analogChannels[item["circuit"]]["deadband"])
+    elif item["dev"] == "ao":
+        Unit = AnalogUnits.get(("ao", item["circuit"]))
+        if Unit is None:
+            return
+        level = int(round(float(item["value"]) * 100 / AO_RANGE))
+        UpdateDevice(Unit, 1 if level > 0 else 0, str(level))
+    return
+
+
+def AnalogSample(circuit, raw):
+    #
+    #   Analog input sampling pipeline: calibrate the raw value with the gain and offset of the channel, store it in
+    #   the fixed size ring buffer of the channel and return the moving average or median over the buffer. The
+    #   filtered value only reaches Domoticz when it moves more than the deadband of the channel, see UpdateItem.
+    #
+    ch = analogChannels.get(circuit)
+    if ch is None:
+        settings = channelSettings.get(("ai", circuit), {})
+        window = max(1, int(settings.get("window", ANALOG_WINDOW)))
+        ch = {"gain": settings.get("gain", 1.0), "offset": settings.get("offset", 0.0),
+              "median": settings.get("filter", ANALOG_FILTER) == "median",
+              "deadband": settings.get("deadband", ANALOG_DEADBAND),
+              "ring": array('d', bytes(8 * window)), "pos": 0, "count": 0}
+        analogChannels[circuit] = ch
+    ring = ch["ring"]
+    ring[ch["pos"]] = raw * ch["gain"] + ch["offset"]
+    ch["pos"] = (ch["pos"] + 1) % len(ring)
+    if ch["count"] < len(ring):
+        ch["count"] += 1
+        samples = ring[:ch["count"]]
+    else:
+        samples = ring
+    if ch["median"]:
+        return statistics.median(samples)
+    return sum(samples) / len(samples)
+
+
+def ParseChannels(settings):
+    #
+    #   Per channel settings, as "ai/1_01:gain=2.5,offset=-0.1,filter=median,window=9,deadband=0.05". Channels are
+    #   separated by ";". Numeric values are stored as float. A setting of ANALOG_NUMBERS that is not a number, or
+    #   an unknown filter, is ignored.
+    #
+    channelSettings.clear()
+    analogChannels.clear()
+    for channel in settings.split(";"):
+        if channel.strip() == "":
+            continue
+        name, sep, values = channel.partition(":")
+        dev, sep, circuit = name.strip().partition("/")
+        if sep == "":
+            Domoticz.Error("Ignored channel setting '" + channel + "': expected dev/circuit:setting=value")
+            continue
+        channel = channelSettings.setdefault((dev, circuit), dict())
+        for setting in values.split(","):
+            key, sep, value = setting.partition("=")
+            key = key.strip()
+            value = value.strip()
+            try:
+                value = float(value)
+            except ValueError:
+                if key in ANALOG_NUMBERS:
+                    Domoticz.Error("Ignored channel setting '" + name.strip() + ":" + setting.strip() +
+                                   "': not a number")
+                    continue
+            if key == "filter" and value not in ANALOG_FILTERS:
+                Domoticz.Error("Ignored channel setting '" + name.strip() + ":" + setting.strip() +
+                               "': filter is one of " + ", ".join(ANALOG_FILTERS))
+                continue
+            channel[key] = value
+    return
+
+
+def UpdateTemp(sensorId, value):
+    Debug("poll", "Update temp from 1-wire sensor %s", sensorId)
+    UpdateDevice(OneWireUnits[sensorId], int(value), str(value), TEMP_DEADBAND, republish=True)
+    return
 
 
 # Generic helper functions
@@ -317,59 +1539,597 @@ def DumpConfigToLog():
         Domoticz.Debug("Device nValue:    " + str(Devices[x].nValue))
         Domoticz.Debug("Device sValue:   '" + Devices[x].sValue + "'")
         Domoticz.Debug("Device LastLevel: " + str(Devices[x].LastLevel))
-    for item in OneWireIds:
-        Domoticz.Debug("1-wire sensor " + item)
+    for item in OneWireUnits:
+        Domoticz.Debug("1-wire sensor " + item + " unit " + str(OneWireUnits[item]))
     return
 
 
-def UpdateDevice(Unit, nValue, sValue):
+def UpdateDevice(Unit, nValue, sValue, deadband=0, republish=False):
+    #
+    #   Write the values to Domoticz only if they differ from the ones last written for this unit, as kept in
+    #   shadow. With a deadband, sValue is numeric, changes smaller than the deadband are ignored and a change is
+    #   held back until WRITE_MIN_INTERVAL seconds after the last write; the first poll after that writes it.
+    #   With republish, unchanged values are written again after REPUBLISH_INTERVAL seconds.
+    #
     # Make sure that the Domoticz device still exists (they can be deleted) before updating it
-    Domoticz.Debug("Update unit no: " + str(Unit) + " value: " + str(nValue) + " " + str(sValue))
+    Debug("poll", "Update unit no: %s value: %s %s", Unit, nValue, sValue)
     if Unit in Devices:
-        if (Devices[Unit].nValue != nValue) or (Devices[Unit].sValue != sValue):
-            Devices[Unit].Update(nValue, str(sValue))
-            Domoticz.Log("Update " + str(nValue) + ":'" + str(sValue) + "' (" + Devices[Unit].Name + ")")
+        sValue = str(sValue)
+        now = time.time()
+        entry = shadow.get(Unit)
+        if entry is not None and not (republish and now - entry[2] >= REPUBLISH_INTERVAL):
+            if deadband:
+                try:
+                    if abs(float(sValue) - float(entry[1])) < deadband or now - entry[2] < WRITE_MIN_INTERVAL:
+                        statsCounts["skipped"] += 1
+                        return
+                except ValueError:
+                    pass
+            elif entry[0] == nValue and entry[1] == sValue:
+                statsCounts["skipped"] += 1
+                return
+        start = time.perf_counter()
+        Devices[Unit].Update(nValue, sValue)
+        elapsed = time.perf_counter() - start
+        Timing("update", elapsed)
+        statsBusy["update"] += elapsed
+        statsCounts["written"] += 1
+        shadow[Unit] = [nValue, sValue, now]
+        if entry is None or entry[0] != nValue or entry[1] != sValue:
+            Info(Unit, "Update %s:'%s' (%s)", nValue, sValue, Devices[Unit].Name)
     return
 
 
+def ShadowDue(Unit, nValue):
+    # True if nValue differs from the last written value of the unit
+    entry = shadow.get(Unit)
+    return entry is None or entry[0] != nValue
+
+
 #   
 #   Control the relay indexed by Unit.
 #       nValue = 0  Relay off
 #       nValue = 1  Relay on
 #    
+#   Commands are queued for the I/O thread, which sends them RELAY_BATCH_WINDOW seconds after the first one, so
+#   the relays of a scene or group are switched together. A later command for the same relay replaces the queued
+#   one. The callback only queues the command; see IoWorker and IoResults.
+#
 def RelaySet(name, nValue):
-    global device
-    global dType
+    Debug("command", "Relay %s value: %s", name, nValue)
+    ctl, url = relayUrls[name]
+    return QueueCommand(ctl, url, nValue)
+
+
+def AnalogSet(circuit, value):
+    Debug("command", "Analog output %s value: %s", circuit, value)
+    ctl, circuit = ControllerOf(circuit)
+    return QueueCommand(ctl, "/rest/ao/" + circuit, value)
+
+
+def QueueCommand(ctl, url, value):
+    # Queue a command for the I/O thread. False if it was refused, then the device must keep its state
+    if ctl["state"] == "open":
+        ioStats["refused"] += 1
+        Domoticz.Error("EVOK on URL " + ctl["url"] + " is not responding: " + url + " not set to " + str(value))
+        return False
+    Activity(ctl)
+    try:
+        ioQueue.put_nowait(("command", ctl["name"], url, value, time.time()))
+    except queue.Full:
+        ioStats["refused"] += 1
+        Domoticz.Error("EVOK is falling behind, " + str(IO_QUEUE_SIZE) + " requests waiting: " + ctl["url"] + url +
+                       " not set to " + str(value))
+        return False
+    ioStats["queued"] += 1
+    ioStats["depth"] = max(ioStats["depth"], ioQueue.qsize())
+    return True
 
-    Domoticz.Debug("Relay " + name + " value: " + str(nValue))
-    response = urlopen("http://" + UNIPI_URL + dType[device]["relays"][name],
-                       bytes(urlencode({'value': str(nValue)}), 'utf-8')).read()
+
+def IoWorker():
+    #
+    #   Body of the I/O thread, which does the blocking EVOK requests and file writes of the plugin. A command is
+    #   held for RELAY_BATCH_WINDOW seconds to gather the commands following it, then the batch is sent
+    #   concurrently over the connection pools. The outcome of every item, and the timing of every batch, is put in
+    #   ioResults; nothing here touches Devices or the Domoticz log, that is left to IoResults on the plugin thread.
+    #
+    stop = False
+    while not stop:
+        work = [ioQueue.get()]
+        if work[0] is not None and work[0][0] == "command":
+            deadline = work[0][4] + RELAY_BATCH_WINDOW
+            while work[-1] is not None and work[-1][0] == "command":
+                try:
+                    work.append(ioQueue.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+        batch = dict()
+        for item in work:
+            if item is None:
+                stop = True
+            elif item[0] == "command":
+                batch[item[1:3]] = item
+            elif item[0] == "save":
+                ioResults.append(("save", item[1], WriteFile(item[1], item[2])))
+        if batch:
+            batch = list(batch.values())
+            sent = time.time()
+            futures = [relayExecutor.submit(RelayPost, controllers[item[1]], item[2], item[3]) for item in batch]
+            for item, future in zip(batch, futures):
+                try:
+                    ioResults.append(item + (future.result(), None, time.time()))
+                except Exception as e:
+                    ioResults.append(item + (None, e, time.time()))
+            done = time.time()
+            ioResults.append(("batch", len(batch), done - sent, done - min(item[4] for item in batch)))
     return
 
 
-def findSensor(strId, data):
-    for item in data:
-        if item["dev"] == "temp":
-            if item["circuit"] == strId and not item["lost"]:
-                return item["value"]
-    return False
+def IoResults():
+    #
+    #   Apply the results of the I/O and fast poll threads, called at the start of the callbacks. The state EVOK
+    #   returns for a command is written to its device; after a failed command the class is polled right away, so
+    #   the device shows the real state again.
+    #
+    while ioResults:
+        result = ioResults.popleft()
+        if result[0] == "poll":
+            ProcessAll(ParseItems(result[2]), False, controllers[result[1]])
+            continue
+        if result[0] == "save":
+            if result[2] is not None:
+                Domoticz.Error(result[1] + " could not be written: " + str(result[2]))
+            continue
+        if result[0] == "batch":
+            Debug("command", "Command batch of %d sent in %.1f ms, %.1f ms after the first command", result[1],
+                  result[2] * 1000, result[3] * 1000)
+            continue
+        kind, name, url, value, queued, response, error, done = result
+        ctl = controllers[name]
+        latency = done - queued
+        ioStats["latency"] = max(ioStats["latency"], latency)
+        if error is not None:
+            ioStats["failed"] += 1
+            Domoticz.Error(ctl["url"] + url + " could not be set to " + str(value) + ": " + str(error))
+            if isinstance(error, OSError):
+                Breaker(ctl, False)
+            cls = url.split("/")[2]
+            if cls not in ctl["periods"]:
+                cls = "modbus" if cls in MODBUS_CLASSES and "modbus" in ctl["periods"] else "discovery"
+            ctl["due"][cls] = 0
+            continue
+        ioStats["sent"] += 1
+        Timing("post", latency)
+        if latency > IO_LATENCY_WARN:
+            Domoticz.Log("EVOK is slow, " + ctl["url"] + url + " set %.1f s after the command" % latency)
+        Debug("command", "%s%s set to %s in %.1f ms, %d requests waiting", ctl["url"], url, value, latency * 1000,
+              ioQueue.qsize())
+        try:
+            item = json.loads(response)
+        except ValueError:
+            continue
+        item = item.get("result", item) if isinstance(item, dict) else None
+        if isinstance(item, dict) and item.get("dev") in ITEM_DEVS and "circuit" in item:
+            item["circuit"] = ctl["prefix"] + item["circuit"]
+            UpdateItem(item)
+    return
 
 
-def checkAppend(sensorId):
+def RelayPost(ctl, url, value):
+    return EvokRequest("POST", url, urlencode({'value': str(value)}), ctl)
+
+
+def EvokRequest(method, url, body=None, ctl=None):
     #
-    #   Scan through all temp devices (index 24 and upward, number of devices given by len(OneWireIds).
-    #   If sensor is not found, create a new temp device. Store sensorId in options field
+    #   Blocking request to the EVOK of a controller, the main controller by default, over a pooled HTTP/1.1
+    #   keep-alive connection. A connection taken from the pool may have been closed by EVOK while idle, in that
+    #   case the request is retried once on a new connection. Returns the response body, raises on connection
+    #   errors and non 200 responses. The connection only goes back to the pool once the body has been read
+    #   completely.
     #
+    if ctl is None:
+        ctl = controllers[""]
+    pool = ctl["pool"]
+    headers = {"Host": ctl["url"], "Connection": "keep-alive"}
+    if body is not None:
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    with httpLock:
+        reused = len(pool) > 0
+        conn = pool.pop() if reused else None
+    while True:
+        if conn is None:
+            conn = http.client.HTTPConnection(ctl["address"], int(ctl["port"]), timeout=HTTP_TIMEOUT)
+        try:
+            conn.request(method, url, body, headers)
+            response = conn.getresponse()
+            break
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            conn = None
+            if not reused:
+                raise
+            reused = False
 
-    global OneWireIds
+    complete = False
+    try:
+        data = response.read()
+        complete = True
+        if response.status != 200:
+            raise http.client.HTTPException("EVOK returned status %d for %s %s" % (response.status, method, url))
+    finally:
+        with httpLock:
+            if not complete or response.will_close or len(pool) >= HTTP_POOL_SIZE:
+                conn.close()
+            else:
+                pool.append(conn)
+    return data
 
-    for n in range(0, len(OneWireIds)):
-        if OneWireIds[n] == sensorId:
+
+def Timing(phase, seconds):
+    #
+    #   Add a duration to the histogram of a phase. The histograms count durations in buckets growing by 2^(1/4),
+    #   so recording is one bisect and a quantile is known within 19%:
+    #       fetch       poll request to EVOK, until the response arrives in onMessage
+    #       post        command, from onCommand until EVOK has confirmed it, see IoWorker
+    #       parse       reading the items from a response, see ParseItems
+    #       dispatch    ProcessAll and ModbusApply, without update
+    #       update      Devices[...].Update
+    #       heartbeat   onHeartbeat
+    #       command     onCommand
+    #
+    statsHist[phase][bisect_left(STATS_BOUNDS, seconds)] += 1
+    statsSum[phase] += seconds
+    return
+
+
+def ResetStats():
+    for phase in STATS_PHASES:
+        statsHist[phase] = array('L', bytes(array('L').itemsize * (len(STATS_BOUNDS) + 1)))
+        statsSum[phase] = 0.0
+    statsCounts["written"] = 0
+    statsCounts["skipped"] = 0
+    return
+
+
+def StatsQuantile(hist, count, q):
+    # Upper bound in ms of the bucket holding quantile q of a histogram with count durations
+    total = 0
+    for n, bucket in enumerate(hist):
+        total += bucket
+        if total >= q * count:
+            return (STATS_BOUNDS[n] if n < len(STATS_BOUNDS) else float("inf")) * 1000
+    return 0.0
+
+
+def StatsReport():
+    # Count, mean, p50, p95 and p99 in ms of every phase, with the update and I/O counters
+    report = {"time": time.time(), "period": statsPeriod, "updates": dict(statsCounts), "io": dict(ioStats),
+              "phases": dict()}
+    for phase in STATS_PHASES:
+        hist = statsHist[phase]
+        count = sum(hist)
+        report["phases"][phase] = {"count": count, "mean": statsSum[phase] * 1000 / count if count else 0.0,
+                                   "p50": StatsQuantile(hist, count, 0.50), "p95": StatsQuantile(hist, count, 0.95),
+                                   "p99": StatsQuantile(hist, count, 0.99)}
+    return report
+
+
+def PublishStats():
+    #
+    #   Every statsPeriod seconds: write the statistics of the period to STATS_FILE, on the I/O thread, show the
+    #   p95 of every phase on its timing sensor and start the next period with empty histograms.
+    #
+    global statsDue
+
+    report = StatsReport()
+    statsDue = time.time() + statsPeriod
+    path = Parameters["HomeFolder"] + STATS_FILE
+    try:
+        ioQueue.put_nowait(("save", path, report))
+    except queue.Full:
+        pass
+    for phase, unit in statsUnits.items():
+        if report["phases"][phase]["count"] > 0:
+            UpdateDevice(unit, 0, "%.2f" % report["phases"][phase]["p95"])
+    if "poll" in logDebug:
+        Domoticz.Debug("Timing p50/p95/p99 ms: " + ", ".join("%s %.2f/%.2f/%.2f" % (phase, t["p50"], t["p95"], t["p99"])
+                                                              for phase, t in report["phases"].items()))
+    ResetStats()
+    return
+
+
+def BuildStats():
+    #
+    #   Find the timing sensors, Custom sensors in ms, and create the missing ones if the statistics are on
+    #
+    statsUnits.clear()
+    for x in Devices:
+        dev, circuit = DeviceCircuit(x)
+        if dev == "stats":
+            statsUnits[circuit] = x
+    if statsPeriod <= 0:
+        return
+    for phase in STATS_PHASES:
+        if phase in statsUnits:
+            continue
+        unit = FreeUnit(STATS_BASE_UNIT)
+        if unit is None:
+            Domoticz.Error("No free unit for the " + phase + " timing sensor")
             return
+        Domoticz.Device(Name="EVOK " + phase + " p95", Unit=unit, TypeName="Custom",
+                        Options={"dev": "stats", "circuit": phase, "Custom": "1;ms"}).Create()
+        statsUnits[phase] = unit
+    return
+
+
+def ParseItems(body):
+    #
+    #   The items of an EVOK response body, a /rest/all document or the part of it returned by the endpoint of a
+    #   single class, decoded in one json.loads. Items with a dev type not in ITEM_DEVS are left out. A body that
+    #   is not valid JSON is logged and gives no items.
+    #
+    start = time.perf_counter()
+    try:
+        data = json.loads(body)
+    except ValueError as e:
+        Domoticz.Error("Invalid JSON from EVOK: " + str(e))
+        data = list()
+    if isinstance(data, dict):
+        data = [data]
+    items = [item for item in data if isinstance(item, dict) and item.get("dev") in ITEM_DEVS and "circuit" in item]
+    Timing("parse", time.perf_counter() - start)
+    return items
+
+
+def findSensor(strId, index):
+    # Value of temp sensor strId in a (dev, circuit) indexed /rest/all document, None if missing or lost
+    item = index.get(("temp", strId))
+    if item is None or item["lost"]:
+        return None
+    return item["value"]
+
+
+def BuildOneWireIndex(cached=None):
+    #
+    #   Rebuild OneWireUnits from the temp devices that have dev and circuit in their Options. Temp devices without
+    #   them take their sensor id from the cache, given as {id: unit}, or as a list of ids on Unit 24 and upward by
+    #   older cache files.
+    #
+    OneWireUnits.clear()
+    for x in sorted(Devices):
+        dev, circuit = DeviceCircuit(x)
+        if dev == "temp":
+            OneWireUnits[circuit] = x
+    if isinstance(cached, list):
+        cached = dict((sensorId, TEMP_BASE_UNIT + n) for n, sensorId in enumerate(cached))
+    if cached is not None:
+        claimed = set(OneWireUnits.values())
+        for sensorId, x in cached.items():
+            if sensorId not in OneWireUnits and x in Devices and x not in claimed and \
+                    DeviceCircuit(x) == (None, None):
+                OneWireUnits[sensorId] = x
+                claimed.add(x)
+    return
+
+
+def BuildAnalogIndex():
+    # Rebuild AnalogUnits from the analog devices that have dev and circuit in their Options
+    AnalogUnits.clear()
+    analogByUnit.clear()
+    for x in Devices:
+        dev, circuit = DeviceCircuit(x)
+        if dev == "ai" or dev == "ao":
+            AnalogUnits[(dev, circuit)] = x
+            analogByUnit[x] = (dev, circuit)
+    return
+
+
+def BuildMeters():
+    #
+    #   Set up a meter for every input with a meter setting in Channel Settings, as "input/1_01:meter=energy,
+    #   ppu=1000,interval=60". The meter is a Domoticz device of its own, next to the switch of the input:
+    #       energy  kWh device, W and Wh, ppu is pulses per kWh
+    #       water   Waterflow device, l/min, ppu is pulses per liter
+    #       pulse   Custom sensor, pulses/s, ppu is pulses per pulse unit
+    #   The device is created if it does not exist yet. The energy total continues from the value in Domoticz.
+    #   A meter whose ppu or interval is not a number above 0 is ignored.
+    #
+    meters.clear()
+    existing = dict()
+    for x in Devices:
+        dev, circuit = DeviceCircuit(x)
+        if dev == "meter":
+            existing[circuit] = x
+    for (dev, circuit), settings in sorted(channelSettings.items()):
+        if dev != "input" or "meter" not in settings:
+            continue
+        type = settings["meter"]
+        if type not in METER_TYPES:
+            Domoticz.Error("Unknown meter type '" + str(type) + "' for input " + circuit)
+            continue
+        try:
+            ppu = float(settings.get("ppu", 1))
+            interval = float(settings.get("interval", METER_INTERVAL))
+        except ValueError:
+            ppu = interval = 0
+        if not ppu > 0 or not interval > 0:
+            Domoticz.Error("Ignored meter of input " + circuit + ": ppu and interval must be numbers above 0")
+            continue
+        meter = {"type": type, "ppu": ppu, "interval": interval, "last": None, "pulses": 0,
+                 "since": time.time(), "total": 0.0, "unit": existing.get(circuit)}
+        if meter["unit"] is None:
+            unit = FreeUnit(METER_BASE_UNIT)
+            if unit is None:
+                Domoticz.Error("No free unit for the meter of input " + circuit)
+                continue
+            options = {"dev": "meter", "circuit": circuit}
+            if type == "pulse":
+                options["Custom"] = "1;pulses/s"
+            Domoticz.Device(Name="Meter " + circuit, Unit=unit, TypeName=METER_TYPES[type], Options=options).Create()
+            Domoticz.Log("Meter for input " + circuit + " added on unit " + str(unit))
+            meter["unit"] = unit
+        elif type == "energy" and ";" in Devices[meter["unit"]].sValue:
+            try:
+                meter["total"] = float(Devices[meter["unit"]].sValue.split(";")[1])
+            except ValueError:
+                pass
+        meters[circuit] = meter
+    return
+
+
+def BuildHealth():
+    #
+    #   Find or create the health device of every controller, an Alert device showing the state of its circuit
+    #   breaker: green when connected, yellow while retrying, red when EVOK does not respond.
+    #
+    existing = dict()
+    for x in Devices:
+        dev, circuit = DeviceCircuit(x)
+        if dev == "health":
+            existing[circuit] = x
+    for ctl in controllers.values():
+        ctl["health"] = existing.get(ctl["name"])
+        if ctl["health"] is None:
+            unit = FreeUnit(HEALTH_BASE_UNIT)
+            if unit is None:
+                Domoticz.Error("No free unit for the health device of EVOK on URL " + ctl["url"])
+                continue
+            Domoticz.Device(Name="EVOK " + (ctl["name"] or "health"), Unit=unit, TypeName="Alert",
+                            Options={"dev": "health", "circuit": ctl["name"]}).Create()
+            Domoticz.Log("Health device for EVOK on URL " + ctl["url"] + " added on unit " + str(unit))
+            ctl["health"] = unit
+    return
+
+
+def CounterDelta(last, counter):
+    #
+    #   Pulses counted by EVOK between two readings of an input counter. The counter wraps at COUNTER_WRAP; a counter
+    #   that went down while it was far from wrapping was reset, by an EVOK restart, and counts from 0.
+    #
+    delta = counter - last
+    if delta < 0:
+        delta = counter + COUNTER_WRAP - last if last > COUNTER_WRAP // 2 else counter
+    return delta
+
+
+def MissedPulses(circuit, Unit, value, counter, mode):
+    #
+    #   Number of pulses of an input that were too short to be seen by polling. mode is the counter_mode of the
+    #   input: EVOK counts the falling edges in mode "falling" (UniPi v1) and the rising edges otherwise, so going
+    #   from level 1 to 0, or from 0 to 1, explains one counted edge; every other counted edge is a pulse that came
+    #   and went between two polls. Nothing is captured while the counter is disabled.
+    #
+    last = inputCounters.get(circuit)
+    inputCounters[circuit] = counter
+    mode = str(mode).lower()
+    if last is None or last == counter or Unit not in Devices or mode == "disabled":
+        return 0
+    previous = shadow[Unit][0] if Unit in shadow else Devices[Unit].nValue
+    edge = (previous, value) == ((1, 0) if mode == "falling" else (0, 1))
+    return max(0, CounterDelta(last, counter) - (1 if edge else 0))
+
+
+def MeterSample(circuit, counter):
+    #
+    #   Add the pulses counted by EVOK since the previous sample to the meter, see CounterDelta. Every interval
+    #   seconds the rate over the interval, and for energy the total, is written to Domoticz.
+    #
+    meter = meters[circuit]
+    now = time.time()
+    if meter["last"] is not None:
+        meter["pulses"] += CounterDelta(meter["last"], counter)
+    else:
+        meter["since"] = now
+    meter["last"] = counter
+
+    elapsed = now - meter["since"]
+    if elapsed < meter["interval"]:
+        return
+    rate = meter["pulses"] / elapsed  # pulses/s
+    ppu = meter["ppu"]
+    if meter["type"] == "energy":
+        meter["total"] += meter["pulses"] * 1000 / ppu
+        UpdateDevice(meter["unit"], 0, "%.1f;%.1f" % (rate * 3600 * 1000 / ppu, meter["total"]))
+    elif meter["type"] == "water":
+        UpdateDevice(meter["unit"], 0, "%.2f" % (rate * 60 / ppu))
+    else:
+        UpdateDevice(meter["unit"], 0, "%.3f" % (rate / ppu))
+    meter["pulses"] = 0
+    meter["since"] = now
+    return
+
+
+def ClaimedUnits():
+    # Set of the units of the 1-wire sensors, analog channels, meters, health devices and timing sensors
+    claimed = set(OneWireUnits.values())
+    claimed.update(AnalogUnits.values())
+    claimed.update(meter["unit"] for meter in meters.values())
+    claimed.update(ctl["health"] for ctl in controllers.values() if ctl["health"] is not None)
+    claimed.update(statsUnits.values())
+    return claimed
+
+
+def FreeUnit(start, adopt=False):
+    #
+    #   First unit from start that is not used by the relay and input map or claimed, see ClaimedUnits.
+    #   With adopt set, a Domoticz device without dev and circuit in its Options also counts as free. None if all
+    #   units up to MAX_UNIT are used.
+    #
+    claimed = ClaimedUnits()
+    unit = start
+    while unit in claimed or unit in unitIndex or (unit in Devices and (not adopt or
+                                                                       DeviceCircuit(unit) != (None, None))):
+        unit += 1
+    return unit if unit <= MAX_UNIT else None
+
+
+def checkAnalog(dev, circuit, item):
+    #
+    #   Create the Domoticz device of an analog input or output that has none yet. Inputs measuring volts are
+    #   Voltage devices, other inputs Custom sensors with the EVOK unit as label, outputs are dimmers.
+    #
+    if (dev, circuit) in AnalogUnits:
+        return
+    unit = FreeUnit(ANALOG_BASE_UNIT)
+    if unit is None:
+        Domoticz.Error("No free unit for " + dev + " " + circuit)
+        return
+    options = {"dev": dev, "circuit": circuit}
+    if dev == "ao":
+        Domoticz.Device(Name="Analog Output " + circuit, Unit=unit, TypeName="Dimmer", Options=options).Create()
+    elif item.get("unit", "V") == "V":
+        Domoticz.Device(Name="Analog Input " + circuit, Unit=unit, TypeName="Voltage", Options=options).Create()
+    else:
+        options["Custom"] = "1;" + str(item["unit"])
+        Domoticz.Device(Name="Analog Input " + circuit, Unit=unit, TypeName="Custom", Options=options).Create()
+    AnalogUnits[(dev, circuit)] = unit
+    analogByUnit[unit] = (dev, circuit)
+    Domoticz.Log("New " + dev + " " + circuit + " found and added on unit " + str(unit))
+    return
+
+
+def checkAppend(sensorId):
+    #
+    #   If the sensor is not in OneWireUnits, map it to a temp device. A temp device created by an earlier version of
+    #   the plugin, without sensor id in its Options, is adopted in unit order like before. Otherwise a new temp
+    #   device is created on the first free unit from TEMP_BASE_UNIT. The sensorId is stored in the Options field.
+    #
+    if sensorId in OneWireUnits:
+        return
+
+    unit = FreeUnit(TEMP_BASE_UNIT, True)
+    if unit is None:
+        Domoticz.Error("No free unit for 1-wire temp sensor " + str(sensorId))
+        return
 
-    OneWireIds.append(sensorId)
-    Domoticz.Device(Name="1-wire sensor #" + str(len(OneWireIds)), Unit=24 + len(OneWireIds) - 1,
-                    TypeName="Temperature", Options=sensorId).Create()
+    options = {"dev": "temp", "circuit": sensorId}
+    OneWireUnits[sensorId] = unit
+    if unit in Devices:
+        Devices[unit].Update(nValue=Devices[unit].nValue, sValue=Devices[unit].sValue, Options=options)
+        Domoticz.Log("1-wire temp sensor " + str(sensorId) + " mapped to existing unit " + str(unit))
+        return
+    Domoticz.Device(Name="1-wire sensor #" + str(len(OneWireUnits)), Unit=unit,
+                    TypeName="Temperature", Options=options).Create()
     Domoticz.Log("New 1-wire temp sensor found and added, id " + str(sensorId))
 
     return